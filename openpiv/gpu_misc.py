@@ -3,36 +3,74 @@ from math import ceil
 
 import numpy as np
 import pycuda.autoinit
+import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
 from pycuda.compiler import SourceModule
+from pycuda.tools import DeviceMemoryPool
 
 # Define 32-bit types.
 DTYPE_i = np.int32
 DTYPE_f = np.float32
 DTYPE_c = np.complex64
 
+_BLOCK_SIZE = 128
+
+# Pool for the short-lived arrays allocated on every call, which avoids a cudaMalloc/cudaFree pair each time.
+_mem_pool = DeviceMemoryPool()
+
+# Compiler options that tell the kernels below the block size they are launched with.
+_KERNEL_OPTIONS = ['-DBLOCK_SIZE={}'.format(_BLOCK_SIZE)]
+
 mod_mask = SourceModule("""
-__global__ void gpu_mask_f(float *f_masked, float *f, int *mask, int size)
+template<typename T>
+__device__ void mask(T * __restrict__ f_masked, const T * __restrict__ f, const int * __restrict__ m, unsigned int size)
 {
-    // frame_masked : output argument
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    // f_masked : output argument
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
-    f_masked[t_idx] = f[t_idx] * (mask[t_idx] == 0.0f);
+    f_masked[t_idx] = f[t_idx] * (m[t_idx] == 0);
 }
 
-__global__ void gpu_mask_i(int *f_masked, int *f, int *mask, int size)
+template<typename T4>
+__device__ void mask4(T4 * __restrict__ f_masked, const T4 * __restrict__ f, const int4 * __restrict__ m,
+                      unsigned int size)
 {
-    // frame_masked : output argument
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    // f_masked : output argument
+    // size : number of 4-element vectors
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
-    f_masked[t_idx] = f[t_idx] * (mask[t_idx] == 0.0f);
+    T4 f4 = f[t_idx];
+    int4 m4 = m[t_idx];
+    f4.x *= (m4.x == 0);
+    f4.y *= (m4.y == 0);
+    f4.z *= (m4.z == 0);
+    f4.w *= (m4.w == 0);
+    f_masked[t_idx] = f4;
+}
+
+extern "C" {
+__global__ void __launch_bounds__(BLOCK_SIZE) gpu_mask_f(float *f_masked, float *f, int *m, unsigned int size)
+{mask<float>(f_masked, f, m, size);}
+
+__global__ void __launch_bounds__(BLOCK_SIZE) gpu_mask_i(int *f_masked, int *f, int *m, unsigned int size)
+{mask<int>(f_masked, f, m, size);}
+
+__global__ void __launch_bounds__(BLOCK_SIZE) gpu_mask_f4(float4 *f_masked, float4 *f, int4 *m, unsigned int size)
+{mask4<float4>(f_masked, f, m, size);}
+
+__global__ void __launch_bounds__(BLOCK_SIZE) gpu_mask_i4(int4 *f_masked, int4 *f, int4 *m, unsigned int size)
+{mask4<int4>(f_masked, f, m, size);}
 }
-""")
+""", options=_KERNEL_OPTIONS, no_extern_c=True)
+_mask_f = mod_mask.get_function('gpu_mask_f').prepare('PPPI')
+_mask_i = mod_mask.get_function('gpu_mask_i').prepare('PPPI')
+_mask_f4 = mod_mask.get_function('gpu_mask_f4').prepare('PPPI')
+_mask_i4 = mod_mask.get_function('gpu_mask_i4').prepare('PPPI')
 
 
-def gpu_mask(f_d, mask_d):
+def gpu_mask(f_d, mask_d, stream=None):
     """Mask an array.
 
     Parameters
@@ -41,6 +79,8 @@ def gpu_mask(f_d, mask_d):
         nD float, frame to be masked.
     mask_d : GPUArray or None, optional
         nD int, mask to apply to frame. 0s are values to keep.
+    stream : Stream or None, optional
+        Stream to launch the kernel on.
 
     Returns
     -------
@@ -53,36 +93,42 @@ def gpu_mask(f_d, mask_d):
     d_type = f_d.dtype
     size = f_d.size
 
-    f_masked_d = gpuarray.empty_like(f_d)
+    f_masked_d = gpuarray.empty(f_d.shape, dtype=d_type, allocator=_mem_pool.allocate)
 
-    block_size = 32
-    grid_size = ceil(size / block_size)
     if d_type == DTYPE_f:
-        mask_gpu = mod_mask.get_function('gpu_mask_f')
+        mask_gpu, mask_gpu4 = _mask_f, _mask_f4
     elif d_type == DTYPE_i:
-        mask_gpu = mod_mask.get_function('gpu_mask_i')
+        mask_gpu, mask_gpu4 = _mask_i, _mask_i4
     else:
         raise ValueError('Wrong data type for f_d.')
-    mask_gpu(f_masked_d, f_d, mask_d, DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+
+    # Use 16-byte vector loads when the whole array can be covered by them.
+    if size % 4 == 0 and _is_aligned(f_masked_d, f_d, mask_d):
+        mask_gpu, size = mask_gpu4, size // 4
+    block_size = _BLOCK_SIZE
+    grid_size = ceil(size / block_size)
+    mask_gpu.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream, f_masked_d.gpudata, f_d.gpudata,
+                                 mask_d.gpudata, size)
 
     return f_masked_d
 
 
 mod_scalar_mod = SourceModule("""
-__global__ void scalar_mod(int *i, int *r, int *f, int m, int size)
+__global__ void __launch_bounds__(BLOCK_SIZE) scalar_mod(int *i, int *r, int *f, int m, unsigned int size)
 {
     // i, r : output arguments
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
     int f_value = f[t_idx];
     i[t_idx] = f_value / m;
     r[t_idx] = f_value % m;
 }
-""")
+""", options=_KERNEL_OPTIONS)
+_scalar_mod = mod_scalar_mod.get_function('scalar_mod').prepare('PPPiI')
 
 
-def gpu_scalar_mod_i(f_d, m):
+def gpu_scalar_mod_i(f_d, m, stream=None):
     """Returns the integer and remainder of division of a PyCUDA array by a scalar int.
 
     Parameters
@@ -91,6 +137,8 @@ def gpu_scalar_mod_i(f_d, m):
         nd int, input to be decomposed.
     m : int
         Modulus.
+    stream : Stream or None, optional
+        Stream to launch the kernel on.
 
     Returns
     -------
@@ -104,13 +152,13 @@ def gpu_scalar_mod_i(f_d, m):
     assert 0 < m == int(m)
     size = f_d.size
 
-    i_d = gpuarray.empty_like(f_d, dtype=DTYPE_i)
-    r_d = gpuarray.empty_like(f_d, dtype=DTYPE_i)
+    i_d = gpuarray.empty(f_d.shape, dtype=DTYPE_i, allocator=_mem_pool.allocate)
+    r_d = gpuarray.empty(f_d.shape, dtype=DTYPE_i, allocator=_mem_pool.allocate)
 
-    block_size = 32
+    block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    mask_frame_gpu = mod_scalar_mod.get_function('scalar_mod')
-    mask_frame_gpu(i_d, r_d, f_d, DTYPE_i(m), DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+    _scalar_mod.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream, i_d.gpudata, r_d.gpudata, f_d.gpudata,
+                                    int(m), size)
 
     return i_d, r_d
 
@@ -118,104 +166,123 @@ def gpu_scalar_mod_i(f_d, m):
 mod_replace_nan_f = SourceModule("""
 #include <math.h>
 
-__global__ void replace_nan_f(float *f, int size)
+__global__ void __launch_bounds__(BLOCK_SIZE) replace_nan_f(float *f, unsigned int size)
 {
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
     
     // Check for NaNs.
     if (std::isnan(f[t_idx])) {f[t_idx] = 0.0f;}
 }
-""")
+""", options=_KERNEL_OPTIONS)
+_replace_nan_f = mod_replace_nan_f.get_function('replace_nan_f').prepare('PI')
 
 
-def gpu_remove_nan_f(f_d):
+def gpu_remove_nan_f(f_d, stream=None):
     """Replaces all NaN from array with zeros.
 
     Parameters
     ----------
     f_d : GPUArray
         nd float.
+    stream : Stream or None, optional
+        Stream to launch the kernel on.
 
     """
     _check_arrays(f_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f)
     size = f_d.size
 
-    block_size = 32
+    block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    replace_nan = mod_replace_nan_f.get_function('replace_nan_f')
-    replace_nan(f_d, DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+    _replace_nan_f.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream, f_d.gpudata, size)
 
 
 mod_replace_negative_f = SourceModule("""
-__global__ void replace_negative_f(float *f, int size)
+__global__ void __launch_bounds__(BLOCK_SIZE) replace_negative_f(float *f, unsigned int size)
 {
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
     float value = f[t_idx];
 
     // Check for negative values.
     f[t_idx] = value * (value > 0.0f);
 }
-""")
+""", options=_KERNEL_OPTIONS)
+_replace_negative_f = mod_replace_negative_f.get_function('replace_negative_f').prepare('PI')
 
 
-def gpu_remove_negative_f(f_d):
+def gpu_remove_negative_f(f_d, stream=None):
     """Replaces all negative values from array with zeros.
 
     Parameters
     ----------
     f_d : GPUArray
         nd float.
+    stream : Stream or None, optional
+        Stream to launch the kernel on.
 
     """
     _check_arrays(f_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f)
     size = f_d.size
 
-    block_size = 32
+    block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    replace_negative = mod_replace_negative_f.get_function('replace_negative_f')
-    replace_negative(f_d, DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+    _replace_negative_f.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream, f_d.gpudata, size)
+
+
+def _to_gpu_pinned(f, f_pinned, stream=None):
+    """Sends an array to the device through a page-locked staging buffer.
+
+    Parameters
+    ----------
+    f : ndarray
+        nD, host array to transfer. It is cast to the dtype of the staging buffer.
+    f_pinned : ndarray
+        nD, page-locked buffer with the same shape as f, e.g. from pycuda.driver.pagelocked_empty().
+    stream : Stream or None, optional
+        Stream to enqueue the transfer on. The staging buffer must not be overwritten before the transfer completes.
+
+    Returns
+    -------
+    GPUArray
+        nD, copy of f on the device.
+
+    """
+    _check_arrays(f_pinned, array_type=np.ndarray, shape=f.shape)
+    f_pinned[...] = f
+
+    f_d = gpuarray.empty(f_pinned.shape, dtype=f_pinned.dtype, allocator=_mem_pool.allocate)
+    cuda.memcpy_htod_async(f_d.gpudata, f_pinned, stream)
+
+    return f_d
+
+
+def _is_aligned(*arrays, alignment=16):
+    """Returns whether the device pointers of all GPUArray inputs are aligned to the given number of bytes."""
+    return all(int(array.gpudata) % alignment == 0 for array in arrays)
 
 
 def _check_arrays(*arrays, array_type=None, dtype=None, shape=None, ndim=None, size=None):
-    """Checks that all array inputs match either each other's or the given array type, dtype, shape and dim."""
-    if not all([array.flags.c_contiguous for array in arrays]):
-        raise ValueError('{} input(s) must be C-contiguous.'.format(len(arrays)))
-    if array_type is not None:
-        if not all([isinstance(array, array_type) for array in arrays]):
-            raise TypeError('{} input(s) must be {}.'.format(len(arrays), array_type))
-    if dtype is not None:
-        if not all([array.dtype == dtype for array in arrays]):
-            raise ValueError('{} input(s) must have dtype {}.'.format(len(arrays), dtype))
-    if shape is not None:
-        if not all([array.shape == shape for array in arrays]):
-            raise ValueError('{} input(s) must have shape {}.'.format(len(arrays), shape))
-    if ndim is not None:
-        if not all([array.ndim == ndim for array in arrays]):
-            raise ValueError('{} input(s) must have ndim {}.'.format(len(arrays), ndim))
-    if size is not None:
-        if not all([array.size == size for array in arrays]):
-            raise ValueError('{} input(s) must have size {}.'.format(len(arrays), size))
-
-
-# def _check_arrays1(*arrays, array_type=None, dtype=None, shape=None, ndim=None, size=None):
-#     """Checks that all array inputs match either each other's or the given array type, dtype, shape and dim."""
-#     for array in arrays:
-#         if not array.flags.c_contiguous:
-#             raise TypeError('{} input(s) must be C-contiguous.'.format(len(arrays)))
-#         if array_type is not None:
-#             if not isinstance(array, array_type):
-#                 raise TypeError('{} input(s) must be {}.'.format(len(arrays), array_type))
-#         if dtype is not None:
-#             if not array.dtype == dtype:
-#                 raise ValueError('{} input(s) must have dtype {}.'.format(len(arrays), dtype))
-#         if shape is not None:
-#             if not array.shape == shape:
-#                 raise ValueError('{} input(s) must have shape {}.'.format(len(arrays), shape))
-#         if ndim is not None:
-#             if not array.ndim == ndim:
-#                 raise ValueError('{} input(s) must have ndim {}.'.format(len(arrays), ndim))
-#         if size is not None:
-#             if not array.size == size:
-#                 raise ValueError('{} input(s) must have size {}.'.format(len(arrays), size))
+    """Checks that all array inputs match either each other's or the given array type, dtype, shape and dim.
+
+    The checks are skipped when Python runs with optimizations (-O).
+
+    """
+    if __debug__:
+        n = len(arrays)
+        # Normalize the references once so each comparison below is a plain equality check.
+        dtype = np.dtype(dtype) if dtype is not None else None
+        shape = tuple(shape) if shape is not None else None
+        for array in arrays:
+            if array_type is not None and not isinstance(array, array_type):
+                raise TypeError('{} input(s) must be {}.'.format(n, array_type))
+            if not array.flags.c_contiguous:
+                raise ValueError('{} input(s) must be C-contiguous.'.format(n))
+            if dtype is not None and array.dtype != dtype:
+                raise ValueError('{} input(s) must have dtype {}.'.format(n, dtype))
+            if shape is not None and array.shape != shape:
+                raise ValueError('{} input(s) must have shape {}.'.format(n, shape))
+            if ndim is not None and array.ndim != ndim:
+                raise ValueError('{} input(s) must have ndim {}.'.format(n, ndim))
+            if size is not None and array.size != size:
+                raise ValueError('{} input(s) must have size {}.'.format(n, size))
@@ -9,17 +9,21 @@ argument to GPU kernels should be multiples of 32 to avoid wasting GPU resources
 """
 import logging
 import warnings
-from math import sqrt, ceil, log2, prod
+from math import sqrt, ceil, prod
 
 import numpy as np
 import pycuda.autoinit
+import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
 import pycuda.cumath as cumath
 from pycuda.compiler import SourceModule
+from pycuda.elementwise import ElementwiseKernel
+from pycuda.reduction import ReductionKernel
 
 from openpiv.gpu_validation import ValidationGPU, ALLOWED_VALIDATION_METHODS, S2N_TOL, MEAN_TOL, MEDIAN_TOL, RMS_TOL
-from openpiv.gpu_smoothn import gpu_smoothn
-from openpiv.gpu_misc import _check_arrays, gpu_scalar_mod_i, gpu_remove_nan_f, gpu_remove_negative_f, gpu_mask
+from openpiv.gpu_smoothn import gpu_smoothn, _fft_plans as _smoothn_fft_plans
+from openpiv.gpu_misc import _check_arrays, _is_aligned, _mem_pool, _to_gpu_pinned, gpu_remove_nan_f, \
+    gpu_remove_negative_f, gpu_mask
 
 # Initialize the scikit-cuda library. This is necessary when certain cumisc calls happen that don't autoinit.
 with warnings.catch_warnings():
@@ -40,7 +44,18 @@ N_FFT = 2
 SUBPIXEL_METHOD = 'gaussian'
 S2N_METHOD = 'peak2peak'
 S2N_WIDTH = 2
-_BLOCK_SIZE = 64
+_BLOCK_SIZE = 256
+_REDUCTION_BLOCK_SIZE = 256
+
+# Image dtypes that are sent to the device as-is and converted to float there.
+_COMPACT_FRAME_DTYPES = {np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.int8), np.dtype(np.int16)}
+
+# cuFFT plans keyed by (shape, input dtype, output dtype, batch, stream), reused across correlation calls.
+_fft_plans = {}
+
+# The frame-A and frame-B windowing pipelines are independent and run on their own streams so that they can overlap.
+_stream_a = cuda.Stream()
+_stream_b = cuda.Stream()
 
 
 class CorrelationGPU:
@@ -91,12 +106,10 @@ class CorrelationGPU:
             'subpixel_method is invalid. Must be one of {}.'.format(ALLOWED_SUBPIXEL_METHODS)
 
         self.n_fft = kwargs['n_fft'] if 'n_fft' in kwargs else N_FFT
-        assert np.all(1 <= DTYPE_i(self.n_fft) == self.n_fft)
-        if isinstance(self.n_fft, int):
-            self.n_fft_x = self.n_fft_y = int(self.n_fft)
-        else:
-            self.n_fft_x = int(self.n_fft[0])
-            self.n_fft_y = self.n_fft_x
+        assert np.all(np.asarray(self.n_fft) >= 1) and np.all(DTYPE_i(self.n_fft) == np.asarray(self.n_fft)), \
+            'n_fft must be an integer equal to or greater than 1.'
+        self.n_fft_x, self.n_fft_y = _get_n_fft(self.n_fft)
+        if np.ndim(self.n_fft) != 0:
             logging.info('For now, n_fft is the same in both directions. ({} is used here.)'.format(self.n_fft_x))
         self.center_field = kwargs['center_field'] if 'center_field' in kwargs else True
         self.s2n_width = kwargs['s2n_width'] if 's2n_width' in kwargs else S2N_WIDTH
@@ -113,9 +126,9 @@ class CorrelationGPU:
             Geometric information for the correlation windows.
         extended_size : int or None, optional
             Extended window size to search in the second frame.
-        shift_d : GPUArray or None, optional
-            2D float ([du, dv]), du and dv are 1D arrays of the x-y shift at each interrogation window of the second
-            frame. This is using the x-y convention of this code where x is the row and y is the column.
+        shift_d : tuple of GPUArray or None, optional
+            (du, dv), 2D float arrays of the x-y shift at each interrogation window of the second frame. This is using
+            the x-y convention of this code where x is the row and y is the column.
         strain_d : GPUArray or None, optional
             2D float ([u_x, u_y, v_x, v_y]), strain tensor.
 
@@ -129,6 +142,7 @@ class CorrelationGPU:
         assert piv_field.window_size >= 8 and piv_field.window_size % 8 == 0, 'Window size must be a multiple of 8.'
         self._extended_size = extended_size if extended_size is not None else piv_field.window_size
         assert (self._extended_size & (self._extended_size - 1)) == 0, 'Window size (extended) must be power of 2.'
+        self._extended_search_offset = (self._extended_size - piv_field.window_size) // 2
         self._sig2noise_d = None
 
         self._init_fft_shape()
@@ -139,14 +153,8 @@ class CorrelationGPU:
         # Correlate the windows.
         self.correlation_d = self._correlate_windows(win_a_d, win_b_d)
 
-        # Get first peak of correlation.
-        self.peak_idx_d = _find_peak(self.correlation_d)
-        self.corr_peak1_d = _get_peak(self.correlation_d, self.peak_idx_d)
-
-        # Get row and column of peak.
-        # TODO Does storing these save time?
-        self.row_peak_d, self.col_peak_d = gpu_scalar_mod_i(self.peak_idx_d, self.fft_wd)
-        self._check_zero_correlation()
+        # Get first peak of correlation, and its row and column.
+        self.corr_peak1_d, self.row_peak_d, self.col_peak_d = _find_peak(self.correlation_d)
 
         # Get the subpixel location.z
         row_sp_d, col_sp_d = _gpu_subpixel_approximation(self.correlation_d, self.row_peak_d, self.col_peak_d,
@@ -167,10 +175,9 @@ class CorrelationGPU:
         return self._get_s2n()
 
     def _init_fft_shape(self):
-        """Creates the shape of the fft windows padded up to power of 2 to boost speed."""
-        self.fft_wd = 2 ** ceil(log2(self._extended_size * self.n_fft_x))
-        self.fft_ht = 2 ** ceil(log2(self._extended_size * self.n_fft_y))
-        self.fft_shape = (self.fft_ht, self.fft_wd)
+        """Creates the shape of the fft windows padded up to a size that cuFFT transforms efficiently."""
+        self.fft_shape = _get_fft_shape(self.piv_field.window_size, self._extended_size, self.n_fft)
+        self.fft_ht, self.fft_wd = self.fft_shape
         self.fft_size = self.fft_wd * self.fft_ht
 
     def _stack_iw(self, frame_a_d, frame_b_d, shift_d, strain_d=None):
@@ -183,15 +190,15 @@ class CorrelationGPU:
         -----------
         frame_a_d, frame_b_d : GPUArray
             2D int (ht, wd), image pair.
-        shift_d : GPUArray
-            3D float (2, m, n), ([du, dv]), shift of the second window.
+        shift_d : tuple of GPUArray or None
+            (du, dv), 2D float (m, n), shift of the second window.
         strain_d : GPUArray or None
             3D float (4, m, n) ([u_x, u_y, v_x, v_y]), strain rate tensor. First dimension is (u_x, u_y, v_x, v_y).
 
         Returns
         -------
         win_a_d, win_b_d : GPUArray
-            3D float (n_windows, ht, wd), interrogation windows stacked in the first dimension.
+            3D float (n_windows, fft_ht, fft_wd), zero-padded interrogation windows stacked in the first dimension.
 
         """
         _check_arrays(frame_a_d, frame_b_d, array_type=gpuarray.GPUArray, shape=frame_a_d.shape, dtype=DTYPE_f, ndim=2)
@@ -204,10 +211,13 @@ class CorrelationGPU:
             buffer_a = center_buffer
             buffer_b = (center_buffer[0] + buffer_b, center_buffer[1] + buffer_b)
 
+        # Windows are written directly into their zero-padded layout for the FFTs.
         win_a_d = _gpu_window_slice(frame_a_d, self.piv_field.shape, self.piv_field.window_size, self.piv_field.spacing,
-                                    buffer_a, dt=-0.5, shift_d=shift_d, strain_d=strain_d)
+                                    buffer_a, dt=-0.5, shift_d=shift_d, strain_d=strain_d, fft_shape=self.fft_shape,
+                                    offset=self._extended_search_offset, stream=_stream_a)
         win_b_d = _gpu_window_slice(frame_b_d, self.piv_field.shape, self._extended_size, self.piv_field.spacing,
-                                    buffer_b, dt=0.5, shift_d=shift_d, strain_d=strain_d)
+                                    buffer_b, dt=0.5, shift_d=shift_d, strain_d=strain_d, fft_shape=self.fft_shape,
+                                    stream=_stream_b)
 
         return win_a_d, win_b_d
 
@@ -217,7 +227,7 @@ class CorrelationGPU:
         Parameters
         ----------
         win_a_d, win_b_d : GPUArray
-            3D float (n_windows, ht, wd), interrogation windows.
+            3D float (n_windows, fft_ht, fft_wd), zero-padded interrogation windows.
 
         Returns
         -------
@@ -228,28 +238,17 @@ class CorrelationGPU:
         _check_arrays(win_a_d, win_b_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=3)
 
         # Normalize array by computing the norm of each IW.
-        win_a_norm_d = _gpu_normalize_intensity(win_a_d)
-        win_b_norm_d = _gpu_normalize_intensity(win_b_d)
-
-        # Zero pad arrays according to extended size requirements.
-        extended_search_offset = (self._extended_size - self.piv_field.window_size) // 2
-        win_a_zp_d = _gpu_zero_pad(win_a_norm_d, self.fft_shape, extended_search_offset=extended_search_offset)
-        win_b_zp_d = _gpu_zero_pad(win_b_norm_d, self.fft_shape)
+        window_size = self.piv_field.window_size
+        win_a_norm_d = _gpu_normalize_intensity(win_a_d, (window_size, window_size), self._extended_search_offset,
+                                                stream=_stream_a)
+        win_b_norm_d = _gpu_normalize_intensity(win_b_d, (self._extended_size, self._extended_size), stream=_stream_b)
 
-        # The second argument in the cross correlation remains stationary.
-        corr_d = _gpu_cross_correlate(win_a_zp_d, win_b_zp_d)
-
-        # Correlation is shifted so that the peak is not on near the boundary.
-        corr_d = gpu_fft_shift(corr_d)
+        # The second argument in the cross correlation remains stationary. The correlation comes out already shifted
+        # so that the peak is not near the boundary.
+        corr_d = _gpu_cross_correlate(win_a_norm_d, win_b_norm_d, stream_a=_stream_a, stream_b=_stream_b)
 
         return corr_d
 
-    def _check_zero_correlation(self):
-        """Sets the row and column to the center if the correlation peak is near zero."""
-        center_d = gpuarray.ones_like(self.row_peak_d, dtype=DTYPE_i) * DTYPE_i(self.fft_wd // 2)
-        self.row_peak_d = gpuarray.if_positive(self.corr_peak1_d, self.row_peak_d, center_d)
-        self.col_peak_d = gpuarray.if_positive(self.corr_peak1_d, self.col_peak_d, center_d)
-
     def _get_displacement(self, row_sp_d, col_sp_d):
         """Returns the relative position of the peaks with respect to the center of the interrogation window."""
         i_peak = row_sp_d - DTYPE_f(self.fft_ht // 2)
@@ -311,16 +310,21 @@ class CorrelationGPU:
         """
         assert self.row_peak_d is not None and self.col_peak_d is not None
 
-        # Set points around the first peak to zero.
-        correlation_masked_d = _gpu_mask_peak(correlation_positive_d, self.row_peak_d, self.col_peak_d, mask_width)
-
-        # Get the height of the second peak of correlation.
-        peak2_idx_d = _find_peak(correlation_masked_d)
-        corr_max2_d = _get_peak(correlation_masked_d, peak2_idx_d)
+        # Get the height of the second peak of correlation, reading the points around the first peak as zero.
+        corr_max2_d, _, _ = _find_peak(correlation_positive_d, self.row_peak_d, self.col_peak_d, mask_width)
 
         return corr_max2_d
 
 
+# Computes sum(x ** 2 + y ** 2) in a single pass.
+_sum_squares = ReductionKernel(DTYPE_f, neutral='0', reduce_expr='a + b', map_expr='x[i] * x[i] + y[i] * y[i]',
+                               arguments='const float *x, const float *y')
+
+# Writes u / dt and v / -dt into the two planes of uv, so that both components come back in a single copy.
+_scale_velocity = ElementwiseKernel('const float *u, const float *v, float *uv, float dt',
+                                    'uv[i] = u[i] / dt; uv[n + i] = v[i] / -dt;', 'scale_velocity')
+
+
 class PIVFieldGPU:
     """Object storing geometric information of PIV windows.
 
@@ -358,14 +362,18 @@ class PIVFieldGPU:
         self.shape = get_field_shape(frame_shape, window_size, spacing)
         self.size = prod(self.shape)
         self._x, self._y = get_field_coords(frame_shape, window_size, spacing, center_field=center_field)
+        self._center_buffer = _get_center_buffer(frame_shape, window_size, spacing)
         assert kwargs == {}
 
         self.is_masked = frame_mask is not None
         self.mask = _get_field_mask(self._x, self._y, frame_mask)
-        self.mask_d = gpuarray.to_gpu(self.mask)
+        # An unmasked field is cleared on the device rather than uploaded from the host.
+        self.mask_d = gpuarray.to_gpu(self.mask) if self.is_masked else gpuarray.zeros(self.shape, dtype=DTYPE_i)
 
-        self._x_grid_d = gpuarray.to_gpu(self._x[0, :].astype(DTYPE_f))
-        self._y_grid_d = gpuarray.to_gpu(self._y[:, 0].astype(DTYPE_f))
+        # Both grid vectors are sent in one transfer.
+        grid_d = gpuarray.to_gpu(np.concatenate((self._x[0, :], self._y[:, 0])).astype(DTYPE_f))
+        self._x_grid_d = grid_d[:self.shape[1]]
+        self._y_grid_d = grid_d[self.shape[1]:]
 
     def get_mask(self):
         """Returns field_mask if frame is mask, None otherwise."""
@@ -381,7 +389,7 @@ class PIVFieldGPU:
 
     @property
     def center_buffer(self):
-        return _get_center_buffer(self.frame_shape, self.window_size, self.spacing)
+        return self._center_buffer
 
 
 def gpu_piv(frame_a, frame_b,
@@ -606,9 +614,14 @@ class PIVGPU:
         self._nb_iter = sum(self.ws_iters)
         self._corr = None
         self._im_mask_d = gpuarray.to_gpu(self.frame_mask) if mask is not None else None
+        self._frames_pinned = [None, None]
+        self._frames_uploaded = [None, None]
+        self._residuals_d = []
+        self.normalized_residual = None
 
         self._check_inputs()
         self._init_fields()
+        self._init_fft_plans()
 
     def __call__(self, frame_a, frame_b):
         """Processes an image pair.
@@ -645,7 +658,7 @@ class PIVGPU:
 
             # CROSS-CORRELATION
             # Get arguments for the correlation class.
-            extended_size = self._get_extended_size()
+            extended_size = self._get_extended_size(k)
             shift_d, strain_d = self._get_window_deformation(dp_u_d, dp_v_d)
 
             # Get window displacement to subpixel accuracy.
@@ -666,9 +679,12 @@ class PIVGPU:
                 v_previous_d = v_d
                 dp_u_d, dp_v_d = self._get_next_iteration_predictions(u_d, v_d)
 
-        u = (u_d / DTYPE_f(self.dt)).get()
-        v = (v_d / DTYPE_f(-self.dt)).get()
+        uv_d = gpuarray.empty((2, *u_d.shape), dtype=DTYPE_f, allocator=_mem_pool.allocate)
+        _scale_velocity(u_d, v_d, uv_d, DTYPE_f(self.dt))
+        u, v = uv_d.get()
 
+        # The host has waited for the device to download the velocity, so the residuals are copied back without a stall.
+        self._check_residuals()
         self._corr.free_frame_data()
 
         return u, v
@@ -686,8 +702,12 @@ class PIVGPU:
         return self._corr.sig2noise_d
 
     def free_data(self):
-        """Frees correlation data from GPU."""
+        """Frees correlation data from GPU, and returns the unused blocks held by the memory pool to the device."""
         self._corr = None
+        self._frames_uploaded = [None, None]
+        for validation_gpu in self._validation_gpus:
+            validation_gpu.free_data()
+        _mem_pool.free_held()
 
     def _init_fields(self):
         """Creates piv-field object at each iteration."""
@@ -698,24 +718,62 @@ class PIVGPU:
             self._piv_fields.append(PIVFieldGPU(self.frame_shape, window_size, spacing, frame_mask=self.frame_mask,
                                                 center_field=self.center_field))
 
+        # The neighbour bitmask only depends on the field shape and mask, so it is found once per field.
+        self._validation_gpus = [ValidationGPU(piv_field.shape, mask_d=piv_field.get_mask(),
+                                               validation_method=self.validation_method, s2n_tol=self.s2n_tol,
+                                               median_tol=self.median_tol, mean_tol=self.mean_tol,
+                                               rms_tol=self.rms_tol)
+                                 for piv_field in self._piv_fields]
+
+        # The smoothed field of each iteration, which seeds the predictors of the next, reuses the same buffers.
+        self._smoothed_fields_d = [(gpuarray.empty(piv_field.shape, dtype=DTYPE_f),
+                                    gpuarray.empty(piv_field.shape, dtype=DTYPE_f))
+                                   for piv_field in self._piv_fields] if self.smooth else None
+
+    def _init_fft_plans(self):
+        """Creates the cuFFT plans of every iteration, so that planning is not done while processing the frames."""
+        for k, piv_field in enumerate(self._piv_fields):
+            fft_shape = _get_fft_shape(piv_field.window_size, self._get_extended_size(k), self.n_fft)
+            _get_correlation_plans(fft_shape, piv_field.size, stream_a=_stream_a, stream_b=_stream_b)
+
     def _mask_frame(self, frame_a, frame_b):
         """Mask the frames before sending to device."""
         _check_arrays(frame_a, frame_b, array_type=np.ndarray, shape=frame_a.shape, ndim=2)
 
-        if self.frame_mask is not None:
-            frame_a_d = gpu_mask(gpuarray.to_gpu(frame_a.astype(DTYPE_f)), self._im_mask_d)
-            frame_b_d = gpu_mask(gpuarray.to_gpu(frame_b.astype(DTYPE_f)), self._im_mask_d)
-        else:
-            frame_a_d = gpuarray.to_gpu(frame_a.astype(DTYPE_f))
-            frame_b_d = gpuarray.to_gpu(frame_b.astype(DTYPE_f))
+        frame_a_d = self._frame_to_gpu(frame_a, 0)
+        frame_b_d = self._frame_to_gpu(frame_b, 1)
 
         return frame_a_d, frame_b_d
 
-    def _get_extended_size(self):
+    def _frame_to_gpu(self, frame, i):
+        """Sends a masked frame to the device as float, transferring 8- and 16-bit images in their native dtype.
+
+        Each frame is uploaded on the stream its windows are sliced on, so that staging the second frame on the host
+        overlaps with the transfer of the first.
+
+        """
+        upload_dtype = frame.dtype if frame.dtype in _COMPACT_FRAME_DTYPES else np.dtype(DTYPE_f)
+        stream = (_stream_a, _stream_b)[i]
+
+        # The staging buffers are free again here since the previous call ended with blocking copies to the host.
+        frame_pinned = self._frames_pinned[i]
+        if frame_pinned is None or frame_pinned.dtype != upload_dtype:
+            frame_pinned = self._frames_pinned[i] = cuda.pagelocked_empty(self.frame_shape, upload_dtype)
+        frame_d = _to_gpu_pinned(frame, frame_pinned, stream=stream)
+
+        # The conversion to float and the masking are done in a single pass over the frame. The upload is held until
+        # the next call, since the conversion may still be reading it after its memory would return to the pool.
+        if upload_dtype != DTYPE_f or self._im_mask_d is not None:
+            self._frames_uploaded[i] = frame_d
+            frame_d = _gpu_frame_to_float(frame_d, self._im_mask_d, stream=stream)
+
+        return frame_d
+
+    def _get_extended_size(self, k):
         """Returns the extended size used during the first iteration."""
         extended_size = None
-        if self._k == 0 and self.extend_ratio is not None:
-            extended_size = int(self._piv_field_k.window_size * self.extend_ratio)
+        if k == 0 and self.extend_ratio is not None:
+            extended_size = int(self._piv_fields[k].window_size * self.extend_ratio)
 
         return extended_size
 
@@ -726,7 +784,7 @@ class PIVGPU:
         strain_d = None
 
         if self._k > 0:
-            shift_d = _get_shift(dp_u_d, dp_v_d)
+            shift_d = (dp_u_d, dp_v_d)
             if self.deform:
                 strain_d = gpu_strain(dp_u_d, dp_v_d, mask_d, self._piv_field_k.spacing)
 
@@ -740,8 +798,7 @@ class PIVGPU:
             u_d = gpu_mask(j_peak_d, mask_d)
             v_d = gpu_mask(i_peak_d, mask_d)
         else:
-            u_d = _gpu_update_field(dp_x_d, j_peak_d, mask_d)
-            v_d = _gpu_update_field(dp_y_d, i_peak_d, mask_d)
+            u_d, v_d = _gpu_update_field(dp_x_d, dp_y_d, j_peak_d, i_peak_d, mask_d)
 
         return u_d, v_d
 
@@ -756,9 +813,7 @@ class PIVGPU:
             sig2noise_d = self._corr.sig2noise_d
 
         # Do the validation.
-        validation_gpu = ValidationGPU(u_d.shape, mask_d=mask_d, validation_method=self.validation_method,
-                                       s2n_tol=self.s2n_tol, median_tol=self.median_tol,
-                                       mean_tol=self.mean_tol, rms_tol=self.rms_tol)
+        validation_gpu = self._validation_gpus[self._k]
         for i in range(self.nb_validation_iter):
             val_locations_d = validation_gpu(u_d, v_d, sig2noise_d=sig2noise_d)
             u_mean_d, v_mean_d = validation_gpu.median_d
@@ -771,6 +826,8 @@ class PIVGPU:
                                                      val_locations_d)
             else:
                 logging.info('No invalid vectors.')
+                # Uniform weights are the same as no weights, which allows the smoothing to stay on the device.
+                val_locations_d = None
                 break
 
             validation_gpu.free_data()
@@ -778,7 +835,8 @@ class PIVGPU:
         # Smooth the validated field.
         if self.smooth:
             w_d = (1 - val_locations_d) if val_locations_d is not None else None
-            u_d, v_d = gpu_smoothn(u_d, v_d, s=self.smoothing_par, mask=mask_d, w=w_d)
+            u_d, v_d = gpu_smoothn(u_d, v_d, s=self.smoothing_par, mask=mask_d, w=w_d,
+                                   out=self._smoothed_fields_d[self._k])
 
         return u_d, v_d
 
@@ -788,8 +846,7 @@ class PIVGPU:
 
         # First iteration, just replace with mean velocity.
         if self._k == 0:
-            u_d = gpuarray.if_positive(val_locations_d, u_mean_d, u_d)
-            v_d = gpuarray.if_positive(val_locations_d, v_mean_d, v_d)
+            u_d, v_d = _gpu_replace_field(u_d, v_d, u_mean_d, v_mean_d, val_locations_d)
 
         # Case if different dimensions: interpolation using previous iteration.
         elif self._k > 0 and self._piv_field_k.shape != self._piv_fields[self._k - 1].shape:
@@ -797,13 +854,15 @@ class PIVGPU:
             x1_d, y1_d = self._piv_fields[self._k].grid_coords_d
             mask_d = self._piv_fields[self._k - 1].get_mask()
 
-            u_d = _interpolate_replace(x0_d, y0_d, x1_d, y1_d, u_previous_d, u_d, val_locations_d, mask_d=mask_d)
-            v_d = _interpolate_replace(x0_d, y0_d, x1_d, y1_d, v_previous_d, v_d, val_locations_d, mask_d=mask_d)
+            # The components are independent, so they are interpolated on separate streams.
+            u_d = _interpolate_replace(x0_d, y0_d, x1_d, y1_d, u_previous_d, u_d, val_locations_d, mask_d=mask_d,
+                                       stream=_stream_a)
+            v_d = _interpolate_replace(x0_d, y0_d, x1_d, y1_d, v_previous_d, v_d, val_locations_d, mask_d=mask_d,
+                                       stream=_stream_b)
 
         # Case if same dimensions.
         elif self._k > 0 and self._piv_field_k.shape == self._piv_fields[self._k - 1].shape:
-            u_d = gpuarray.if_positive(val_locations_d, u_previous_d, u_d)
-            v_d = gpuarray.if_positive(val_locations_d, v_previous_d, v_d)
+            u_d, v_d = _gpu_replace_field(u_d, v_d, u_previous_d, v_previous_d, val_locations_d)
 
         return u_d, v_d
 
@@ -816,8 +875,9 @@ class PIVGPU:
 
         # Interpolate if dimensions do not agree.
         if self._piv_fields[self._k + 1].window_size != self._piv_field_k.window_size:
-            dp_u_d = gpu_interpolate(x0_d, y0_d, x1_d, y1_d, u_d, mask_d=mask_d)
-            dp_v_d = gpu_interpolate(x0_d, y0_d, x1_d, y1_d, v_d, mask_d=mask_d)
+            # The components are independent, so they are interpolated on separate streams.
+            dp_u_d = gpu_interpolate(x0_d, y0_d, x1_d, y1_d, u_d, mask_d=mask_d, stream=_stream_a)
+            dp_v_d = gpu_interpolate(x0_d, y0_d, x1_d, y1_d, v_d, mask_d=mask_d, stream=_stream_b)
         else:
             dp_u_d = u_d
             dp_v_d = v_d
@@ -825,17 +885,28 @@ class PIVGPU:
         return dp_u_d, dp_v_d
 
     def _log_residual(self, i_peak_d, j_peak_d):
-        """Normalizes the residual by the maximum quantization error of 0.5 pixel."""
+        """Sums the squared residual on the device, and logs it right away only if info logging is on."""
         _check_arrays(i_peak_d, j_peak_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=i_peak_d.shape)
 
-        try:
-            normalized_residual = sqrt(int(gpuarray.sum(i_peak_d ** 2 + j_peak_d ** 2).get()) / i_peak_d.size) / 0.5
-            logging.info('Normalized residual : {}.'.format(normalized_residual))
-        except OverflowError:
-            logging.warning('Overflow in residuals.')
-            normalized_residual = np.nan
+        # Copying the sum back blocks the host on the device, so it is deferred to the end of the frame pair unless
+        # every iteration is logged.
+        self._residuals_d.append((_sum_squares(i_peak_d, j_peak_d), i_peak_d.size))
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            self._check_residuals()
+
+    def _check_residuals(self):
+        """Normalizes the pending residuals by the maximum quantization error of 0.5 pixel."""
+        for sum_squares_d, size in self._residuals_d:
+            sum_squares = float(sum_squares_d.get())
+            if np.isfinite(sum_squares):
+                normalized_residual = sqrt(sum_squares / size) / 0.5
+                logging.info('Normalized residual : {}.'.format(normalized_residual))
+            else:
+                logging.warning('Overflow in residuals.')
+                normalized_residual = np.nan
 
-        self.normalized_residual = normalized_residual
+            self.normalized_residual = normalized_residual
+        self._residuals_d = []
 
     def _check_inputs(self):
         if int(self.frame_shape[0]) != self.frame_shape[0] or int(self.frame_shape[1]) != self.frame_shape[1]:
@@ -867,8 +938,8 @@ class PIVGPU:
         if not all(0 < tol == float(tol) or tol is None for tol in
                    [self.s2n_tol, self.median_tol, self.mean_tol, self.rms_tol]):
             raise ValueError('Validation tolerances must be positive numbers.')
-        if not 1 < self.n_fft == float(self.n_fft):
-            raise ValueError('n_fft must be an number equal to or greater than 1.')
+        if not (np.all(np.asarray(self.n_fft) >= 1) and np.all(DTYPE_i(self.n_fft) == np.asarray(self.n_fft))):
+            raise ValueError('n_fft must be an integer equal to or greater than 1.')
         if self.s2n_method not in ALLOWED_S2N_METHODS:
             raise ValueError('sig2noise_method is not allowed. Allowed is one of: {}'.format(ALLOWED_S2N_METHODS))
         if self.subpixel_method not in ALLOWED_SUBPIXEL_METHODS:
@@ -936,8 +1007,10 @@ def get_field_coords(frame_shape, window_size, spacing, center_field=True):
     buffer_y = 0
     if center_field:
         buffer_x, buffer_y = _get_center_buffer(frame_shape, window_size, spacing)
-    x = np.tile(np.linspace(half_width + buffer_x, half_width + buffer_x + spacing * (n - 1), n), (m, 1))
-    y = np.tile(np.linspace(half_width + buffer_y + spacing * (m - 1), half_width + buffer_y, m), (n, 1)).T
+    x_grid = np.linspace(half_width + buffer_x, half_width + buffer_x + spacing * (n - 1), n)
+    y_grid = np.linspace(half_width + buffer_y + spacing * (m - 1), half_width + buffer_y, m)
+    x = np.broadcast_to(x_grid, (m, n)).copy()
+    y = np.broadcast_to(y_grid[:, np.newaxis], (m, n)).copy()
 
     return x, y
 
@@ -968,10 +1041,12 @@ __global__ void strain_gpu(float *strain, float *u, float *v, int *mask, float h
     idx1 = idx1 * !mask[idx1] + idx * mask[idx1];
 
     // Do the differencing.
-    strain[size * gradient_axis + idx] = (u[idx1] - u[idx0]) / (1 + interior) / h;
-    strain[size * (gradient_axis + 2) + idx] = (v[idx1] - v[idx0]) / (1 + interior) / h;
+    float scale = 1.0f / ((1 + interior) * h);
+    strain[size * gradient_axis + idx] = (u[idx1] - u[idx0]) * scale;
+    strain[size * (gradient_axis + 2) + idx] = (v[idx1] - v[idx0]) * scale;
 }
 """)
+_strain_gpu = mod_strain.get_function('strain_gpu').prepare('PPPPfiii')
 
 
 def gpu_strain(u_d, v_d, mask_d=None, spacing=1):
@@ -999,15 +1074,14 @@ def gpu_strain(u_d, v_d, mask_d=None, spacing=1):
     if mask_d is not None:
         _check_arrays(mask_d, array_type=gpuarray.GPUArray, shape=u_d.shape, dtype=DTYPE_i)
     else:
-        mask_d = gpuarray.zeros_like(u_d, dtype=DTYPE_i)
+        mask_d = gpuarray.zeros(u_d.shape, dtype=DTYPE_i, allocator=_mem_pool.allocate)
 
-    strain_d = gpuarray.empty((4, m, n), dtype=DTYPE_f)
+    strain_d = gpuarray.empty((4, m, n), dtype=DTYPE_f, allocator=_mem_pool.allocate)
 
     block_size = _BLOCK_SIZE
     n_blocks = ceil(size * 2 / block_size)
-    strain_gpu = mod_strain.get_function('strain_gpu')
-    strain_gpu(strain_d, u_d, v_d, mask_d, DTYPE_f(spacing), DTYPE_i(m), DTYPE_i(n), DTYPE_i(size),
-               block=(block_size, 1, 1), grid=(n_blocks, 1))
+    _strain_gpu.prepared_call((n_blocks, 1), (block_size, 1, 1), strain_d.gpudata, u_d.gpudata, v_d.gpudata,
+                              mask_d.gpudata, DTYPE_f(spacing), m, n, size)
 
     return strain_d
 
@@ -1031,6 +1105,7 @@ __global__ void fft_shift(float *destination, float *source, int ht, int wd, int
     destination[d_idx] = source[s_idx];
 }
 """)
+_fft_shift = mod_fft_shift.get_function('fft_shift').prepare('PPiii')
 
 
 def gpu_fft_shift(correlation_d):
@@ -1051,33 +1126,49 @@ def gpu_fft_shift(correlation_d):
     n_windows, ht, wd = correlation_d.shape
     window_size = ht * wd
 
-    correlation_shift_d = gpuarray.empty_like(correlation_d, dtype=DTYPE_f)
+    correlation_shift_d = gpuarray.empty(correlation_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
 
-    block_size = 8
-    grid_size = ceil(max(ht, wd) / block_size)
-    fft_shift = mod_fft_shift.get_function('fft_shift')
-    fft_shift(correlation_shift_d, correlation_d, DTYPE_i(ht), DTYPE_i(wd), DTYPE_i(window_size),
-              block=(block_size, block_size, 1), grid=(n_windows, grid_size, grid_size))
+    # Rows of the window map to consecutive threads so that warps access contiguous memory.
+    block_size_x = min(32, wd)
+    block_size_y = 256 // block_size_x
+    grid_size_x = ceil(wd / block_size_x)
+    grid_size_y = ceil(ht / block_size_y)
+    _fft_shift.prepared_call((n_windows, grid_size_x, grid_size_y), (block_size_x, block_size_y, 1),
+                             correlation_shift_d.gpudata, correlation_d.gpudata, ht, wd, window_size)
 
     return correlation_shift_d
 
 
 mod_interpolate = SourceModule("""
-__global__ void bilinear_interpolation(float *f1, float *f0, float *x_grid, float *y_grid, float buffer_x,
-                    float buffer_y, float spacing_x, float spacing_y, int ht, int wd, int n, int size)
+// Maps a coordinate to the index space of a uniform grid, using the first two points of the grid.
+__device__ float grid_index(const float *grid, float coord)
+{
+    float buffer = grid[0];
+    return (coord - buffer) / (grid[1] - buffer);
+}
+
+__global__ void bilinear_interpolation(float * __restrict__ f1, const float * __restrict__ f0,
+                    const float * __restrict__ x_grid0, const float * __restrict__ y_grid0,
+                    const float * __restrict__ x_grid, const float * __restrict__ y_grid,
+                    const int * __restrict__ val_locations, const float * __restrict__ f_valid, int ht, int wd, int n,
+                    int size)
 {
+    // val_locations : if not null, only these locations are interpolated and the rest are copied from f_valid
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
+    // Valid points skip the interpolation and gather only their own value.
+    if (val_locations != NULL && !val_locations[t_idx]) {f1[t_idx] = f_valid[t_idx]; return;}
+
     // Map indices to old mesh coordinates.
     int x_idx = t_idx % n;
     int y_idx = t_idx / n;
-    float x = (x_grid[x_idx] - buffer_x) / spacing_x;
-    float y = (y_grid[y_idx] - buffer_y) / spacing_y;
+    float x = grid_index(x_grid0, x_grid[x_idx]);
+    float y = grid_index(y_grid0, y_grid[y_idx]);
 
     // Coerce interpolation point to within limits of domain.
-    x = x * (x >= 0.0f && x <= wd - 1) + (wd - 1) * (x > wd - 1);
-    y = y * (y >= 0.0f && y <= ht - 1) + (ht - 1) * (y > ht - 1);
+    x = fminf(fmaxf(x, 0.0f), wd - 1);
+    y = fminf(fmaxf(y, 0.0f), ht - 1);
 
     // Get neighbouring points.
     int x1 = floorf(x) - (x == wd - 1);
@@ -1086,27 +1177,34 @@ __global__ void bilinear_interpolation(float *f1, float *f0, float *x_grid, floa
     int y2 = y1 + 1;
 
     // Apply the mapping.
-    f1[t_idx] = (x2 - x) * (y2 - y) * f0[y1 * wd + x1]  // f11
-                + (x - x1) * (y2 - y) * f0[y1 * wd + x2]  // f21
-                + (x2 - x) * (y - y1) * f0[y2 * wd + x1]  // f12
-                + (x - x1) * (y - y1) * f0[y2 * wd + x2];  // f22
+    float f = (x2 - x) * (y2 - y) * f0[y1 * wd + x1]  // f11
+              + (x - x1) * (y2 - y) * f0[y1 * wd + x2]  // f21
+              + (x2 - x) * (y - y1) * f0[y2 * wd + x1]  // f12
+              + (x - x1) * (y - y1) * f0[y2 * wd + x2];  // f22
+    f1[t_idx] = f;
 }
 
-__global__ void bilinear_interpolation_mask(float *f1, float *f0, float *x_grid, float *y_grid, int *mask,
-                    float buffer_x, float buffer_y, float spacing_x, float spacing_y, int ht, int wd, int n, int size)
+__global__ void bilinear_interpolation_mask(float * __restrict__ f1, const float * __restrict__ f0,
+                    const float * __restrict__ x_grid0, const float * __restrict__ y_grid0,
+                    const float * __restrict__ x_grid, const float * __restrict__ y_grid, const int * __restrict__ mask,
+                    const int * __restrict__ val_locations, const float * __restrict__ f_valid, int ht, int wd, int n,
+                    int size)
 {
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
+    // Valid points skip the interpolation and gather only their own value.
+    if (val_locations != NULL && !val_locations[t_idx]) {f1[t_idx] = f_valid[t_idx]; return;}
+
     // Map indices to old mesh coordinates.
     int x_idx = t_idx % n;
     int y_idx = t_idx / n;
-    float x = (x_grid[x_idx] - buffer_x) / spacing_x;
-    float y = (y_grid[y_idx] - buffer_y) / spacing_y;
+    float x = grid_index(x_grid0, x_grid[x_idx]);
+    float y = grid_index(y_grid0, y_grid[y_idx]);
 
     // Coerce interpolation point to within limits of domain.
-    x = x * (x >= 0.0f && x <= wd - 1) + (wd - 1) * (x > wd - 1);
-    y = y * (y >= 0.0f && y <= ht - 1) + (ht - 1) * (y > ht - 1);
+    x = fminf(fmaxf(x, 0.0f), wd - 1);
+    y = fminf(fmaxf(y, 0.0f), ht - 1);
 
     // Get neighbouring points.
     int x1 = floorf(x) - (x == wd - 1);
@@ -1119,23 +1217,31 @@ __global__ void bilinear_interpolation_mask(float *f1, float *f0, float *x_grid,
     int m21 = mask[y1 * wd + x2];
     int m12 = mask[y2 * wd + x1];
     int m22 = mask[y2 * wd + x2];
-    int m_y1 = m11 * m21;
-    int m_y2 = m12 * m22;
-
-    // Apply the mapping along x-axis.
-    float f_y1 = ((x2 - x) * (!m11 * !m21) + (!m11 * m21)) * f0[y1 * wd + x1]  // f11
-                 + ((x - x1) * (!m11 * !m21) + (m11 * !m21)) * f0[y1 * wd + x2]; // f21
-    float f_y2 = ((x2 - x) * (!m12 * !m22) + (!m12 * m22)) * f0[y2 * wd + x1] // f12
-                 + ((x - x1) * (!m12 * !m22) + (m12 * !m22)) * f0[y2 * wd + x2]; // f22
-
-    // Apply the mapping along y-axis.
-    f1[t_idx] = ((y2 - y) * (!m_y1 * !m_y2) + (!m_y1 * m_y2)) * f_y1
-                + ((y - y1) * (!m_y1 * !m_y2) + (m_y1 * !m_y2)) * f_y2;
+
+    // Weights along x-axis, which fall back to the other point when one of the pair is masked.
+    float w11 = m11 ? 0.0f : (m21 ? 1.0f : x2 - x);
+    float w21 = m21 ? 0.0f : (m11 ? 1.0f : x - x1);
+    float w12 = m12 ? 0.0f : (m22 ? 1.0f : x2 - x);
+    float w22 = m22 ? 0.0f : (m12 ? 1.0f : x - x1);
+
+    // Weights along y-axis, where a row is masked if both of its points are.
+    int m_y1 = m11 && m21;
+    int m_y2 = m12 && m22;
+    float w_y1 = m_y1 ? 0.0f : (m_y2 ? 1.0f : y2 - y);
+    float w_y2 = m_y2 ? 0.0f : (m_y1 ? 1.0f : y - y1);
+
+    // Apply the mapping.
+    float f_y1 = w11 * f0[y1 * wd + x1] + w21 * f0[y1 * wd + x2];  // f11, f21
+    float f_y2 = w12 * f0[y2 * wd + x1] + w22 * f0[y2 * wd + x2];  // f12, f22
+    float f = w_y1 * f_y1 + w_y2 * f_y2;
+    f1[t_idx] = f;
 }
 """)
+_bilinear_interpolation_mask = mod_interpolate.get_function('bilinear_interpolation_mask').prepare('PPPPPPPPPiiii')
+_bilinear_interpolation = mod_interpolate.get_function('bilinear_interpolation').prepare('PPPPPPPPiiii')
 
 
-def gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=None):
+def gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=None, stream=None):
     """Performs an interpolation of a field from one mesh to another.
 
     The implementation requires that the mesh spacing is uniform. The spacing can be different in x and y directions.
@@ -1150,6 +1256,8 @@ def gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=None):
         2D float (y0_d.size, x0_d.size), field to be interpolated.
     mask_d : (y0_d.size, x0_d.size): GPUArray, optional
         2D float, value of one where masked values are.
+    stream : Stream or None, optional
+        CUDA stream on which to launch the kernel.
 
     Returns
     -------
@@ -1157,35 +1265,45 @@ def gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=None):
         2D float (x1_d.size, y1_d.size), interpolated field.
 
     """
+    return _gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=mask_d, stream=stream)
+
+
+def _gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=None, val_locations_d=None, f1_d=None, stream=None):
+    """Interpolates a field onto another mesh, optionally only at the locations where val_locations_d is non-zero."""
     _check_arrays(x0_d, y0_d, x1_d, y1_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=1)
     ht = y0_d.size
     wd = x0_d.size
     _check_arrays(f0_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=2, shape=(ht, wd))
+    assert ht >= 2 and wd >= 2, 'The original grid must have at least two points in each direction.'
     n = x1_d.size
     m = y1_d.size
     size = m * n
 
-    f1_d = gpuarray.empty((m, n), dtype=DTYPE_f)
+    # The values at the valid locations are taken from f1_d.
+    val_ptr = f1_ptr = np.intp(0)
+    if val_locations_d is not None:
+        _check_arrays(val_locations_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=(m, n))
+        _check_arrays(f1_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=(m, n))
+        val_ptr = val_locations_d.gpudata
+        f1_ptr = f1_d.gpudata
 
-    # Calculate the relationship between the two grid coordinates.
-    buffer_x_f = DTYPE_f(x0_d[0].get())
-    buffer_y_f = DTYPE_f(y0_d[0].get())
-    spacing_x_f = DTYPE_f((x0_d[1].get() - buffer_x_f))
-    spacing_y_f = DTYPE_f((y0_d[1].get() - buffer_y_f))
+    f1_val_d = gpuarray.empty((m, n), dtype=DTYPE_f, allocator=_mem_pool.allocate)
 
+    # The relationship between the two grids is computed by the kernel, which avoids copying the grids to the host.
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
     if mask_d is not None:
         _check_arrays(mask_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=f0_d.shape)
-        interpolate_gpu = mod_interpolate.get_function('bilinear_interpolation_mask')
-        interpolate_gpu(f1_d, f0_d, x1_d, y1_d, mask_d, buffer_x_f, buffer_y_f, spacing_x_f, spacing_y_f, DTYPE_i(ht),
-                        DTYPE_i(wd), DTYPE_i(n), DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+        _bilinear_interpolation_mask.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream,
+                                                         f1_val_d.gpudata, f0_d.gpudata, x0_d.gpudata, y0_d.gpudata,
+                                                         x1_d.gpudata, y1_d.gpudata, mask_d.gpudata, val_ptr, f1_ptr,
+                                                         ht, wd, n, size)
     else:
-        interpolate_gpu = mod_interpolate.get_function('bilinear_interpolation')
-        interpolate_gpu(f1_d, f0_d, x1_d, y1_d, buffer_x_f, buffer_y_f, spacing_x_f, spacing_y_f, DTYPE_i(ht),
-                        DTYPE_i(wd), DTYPE_i(n), DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+        _bilinear_interpolation.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream, f1_val_d.gpudata,
+                                                    f0_d.gpudata, x0_d.gpudata, y0_d.gpudata, x1_d.gpudata,
+                                                    y1_d.gpudata, val_ptr, f1_ptr, ht, wd, n, size)
 
-    return f1_d
+    return f1_val_d
 
 
 def _get_window_sizes(ws_iters, min_window_size):
@@ -1200,10 +1318,51 @@ def _get_spacing(window_size, overlap_ratio):
     return max(1, int(window_size * (1 - overlap_ratio)))
 
 
+def _get_fft_size(n):
+    """Returns the smallest even size of at least n with no prime factors other than 2, 3, 5 and 7.
+
+    cuFFT has optimized kernels for these sizes, and even sizes allow the fft-shift to be done in the frequency domain.
+
+    """
+    size = max(2, n + n % 2)
+    while True:
+        remainder = size
+        for factor in (2, 3, 5, 7):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return size
+        size += 2
+
+
+def _get_n_fft(n_fft):
+    """Returns the window size multipliers for the fft in the x and y directions.
+
+    For now, the multiplier is the same in both directions, so only the first one is used if a tuple is given.
+
+    """
+    n_fft_x = int(n_fft) if np.ndim(n_fft) == 0 else int(n_fft[0])
+
+    return n_fft_x, n_fft_x
+
+
+def _get_fft_shape(window_size, extended_size, n_fft):
+    """Returns the (ht, wd) shape of the correlation windows, padded up to a size that cuFFT transforms efficiently.
+
+    This is shared by the correlation and the planning done ahead of it, so that both use the same shapes.
+
+    """
+    extended_size = extended_size if extended_size is not None else window_size
+    n_fft_x, n_fft_y = _get_n_fft(n_fft)
+
+    return _get_fft_size(extended_size * n_fft_y), _get_fft_size(extended_size * n_fft_x)
+
+
 def _get_field_mask(x, y, frame_mask=None):
     """Creates field mask from frame mask."""
     if frame_mask is not None:
-        mask = frame_mask[y.astype(DTYPE_i), x.astype(DTYPE_i)]
+        # The field is a regular grid, so the mask is indexed by the outer product of its rows and columns.
+        mask = frame_mask[np.ix_(y[:, 0].astype(DTYPE_i), x[0, :].astype(DTYPE_i))]
     else:
         mask = np.zeros_like(x, dtype=DTYPE_i)
 
@@ -1226,10 +1385,128 @@ def _get_center_buffer(frame_shape, window_size, spacing):
     return buffer_x, buffer_y
 
 
+mod_frame = SourceModule("""
+template<typename T>
+__device__ void frame_to_float(float * __restrict__ f, const T * __restrict__ frame, const int * __restrict__ mask,
+                               unsigned int size)
+{
+    // f : output argument
+    // mask : points where it is non-zero are set to zero, unless it is null
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    if (t_idx >= size) {return;}
+
+    float value = static_cast<float>(frame[t_idx]);
+    f[t_idx] = mask != NULL ? value * (mask[t_idx] == 0) : value;
+}
+
+template<typename T4>
+__device__ void frame_to_float4(float4 * __restrict__ f, const T4 * __restrict__ frame,
+                                const int4 * __restrict__ mask, unsigned int size)
+{
+    // f : output argument
+    // size : number of 4-element vectors
+    unsigned int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
+    if (t_idx >= size) {return;}
+
+    T4 p = frame[t_idx];
+    float4 value = make_float4(p.x, p.y, p.z, p.w);
+    if (mask != NULL) {
+        int4 m4 = mask[t_idx];
+        value.x *= (m4.x == 0);
+        value.y *= (m4.y == 0);
+        value.z *= (m4.z == 0);
+        value.w *= (m4.w == 0);
+    }
+    f[t_idx] = value;
+}
+
+extern "C" {
+__global__ void frame_to_float_u8(float *f, unsigned char *frame, int *mask, unsigned int size)
+{frame_to_float<unsigned char>(f, frame, mask, size);}
+
+__global__ void frame_to_float_u16(float *f, unsigned short *frame, int *mask, unsigned int size)
+{frame_to_float<unsigned short>(f, frame, mask, size);}
+
+__global__ void frame_to_float_i8(float *f, signed char *frame, int *mask, unsigned int size)
+{frame_to_float<signed char>(f, frame, mask, size);}
+
+__global__ void frame_to_float_i16(float *f, short *frame, int *mask, unsigned int size)
+{frame_to_float<short>(f, frame, mask, size);}
+
+__global__ void frame_to_float_f(float *f, float *frame, int *mask, unsigned int size)
+{frame_to_float<float>(f, frame, mask, size);}
+
+__global__ void frame_to_float_u84(float4 *f, uchar4 *frame, int4 *mask, unsigned int size)
+{frame_to_float4<uchar4>(f, frame, mask, size);}
+
+__global__ void frame_to_float_u164(float4 *f, ushort4 *frame, int4 *mask, unsigned int size)
+{frame_to_float4<ushort4>(f, frame, mask, size);}
+
+__global__ void frame_to_float_i84(float4 *f, char4 *frame, int4 *mask, unsigned int size)
+{frame_to_float4<char4>(f, frame, mask, size);}
+
+__global__ void frame_to_float_i164(float4 *f, short4 *frame, int4 *mask, unsigned int size)
+{frame_to_float4<short4>(f, frame, mask, size);}
+
+__global__ void frame_to_float_f4(float4 *f, float4 *frame, int4 *mask, unsigned int size)
+{frame_to_float4<float4>(f, frame, mask, size);}
+}
+""", no_extern_c=True)
+_frame_to_float = {np.dtype(d_type): mod_frame.get_function('frame_to_float_' + suffix).prepare('PPPI')
+                   for d_type, suffix in [(np.uint8, 'u8'), (np.uint16, 'u16'), (np.int8, 'i8'), (np.int16, 'i16'),
+                                          (DTYPE_f, 'f')]}
+_frame_to_float4 = {np.dtype(d_type): mod_frame.get_function('frame_to_float_' + suffix + '4').prepare('PPPI')
+                    for d_type, suffix in [(np.uint8, 'u8'), (np.uint16, 'u16'), (np.int8, 'i8'), (np.int16, 'i16'),
+                                           (DTYPE_f, 'f')]}
+
+
+def _gpu_frame_to_float(frame_d, mask_d=None, stream=None):
+    """Returns a frame converted to float, with the masked points set to zero.
+
+    Parameters
+    ----------
+    frame_d : GPUArray
+        2D (ht, wd), frame in one of the compact image dtypes or float.
+    mask_d : GPUArray or None, optional
+        2D int (ht, wd), mask to apply to the frame. 0s are values to keep.
+    stream : Stream or None, optional
+        Stream to launch the kernel on.
+
+    Returns
+    -------
+    GPUArray
+        2D float (ht, wd), masked frame.
+
+    """
+    _check_arrays(frame_d, array_type=gpuarray.GPUArray, ndim=2)
+    assert frame_d.dtype in _frame_to_float, 'Frame dtype must be one of {}.'.format(set(_frame_to_float))
+    size = frame_d.size
+    if mask_d is not None:
+        _check_arrays(mask_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=frame_d.shape)
+
+    f_d = gpuarray.empty(frame_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
+
+    # Use vector loads when the whole frame can be covered by them.
+    frame_to_float = _frame_to_float[frame_d.dtype]
+    arrays = (f_d, frame_d) if mask_d is None else (f_d, frame_d, mask_d)
+    if size % 4 == 0 and _is_aligned(*arrays):
+        frame_to_float, size = _frame_to_float4[frame_d.dtype], size // 4
+    block_size = _BLOCK_SIZE
+    grid_size = ceil(size / block_size)
+    mask_ptr = mask_d.gpudata if mask_d is not None else np.intp(0)
+    frame_to_float.prepared_async_call((grid_size, 1), (block_size, 1, 1), stream, f_d.gpudata, frame_d.gpudata,
+                                       mask_ptr, size)
+
+    return f_d
+
+
 mod_window_slice = SourceModule("""
-__global__ void window_slice(float *output, float *input, int ws, int spacing, int buffer_x, int buffer_y, int n,
-                    int wd, int ht)
+__global__ void window_slice(float * __restrict__ output, const float * __restrict__ input, int ws, int spacing,
+                    int buffer_x, int buffer_y, int n, int wd, int ht, int out_ht, int out_wd, int offset)
 {
+    // out_ht, out_wd : shape of each output window, which may be zero-padded
+    // offset : row and column of the output window where the interrogation window starts
+    // Overlapping windows read the same pixels, so the frame is read through the read-only cache.
     // x blocks are windows; y and z blocks are x and y dimensions, respectively.
     int idx_i = blockIdx.x;
     int idx_x = blockIdx.y * blockDim.x + threadIdx.x;
@@ -1241,23 +1518,23 @@ __global__ void window_slice(float *output, float *input, int ws, int spacing, i
     int y = (idx_i / n) * spacing + buffer_y + idx_y;
 
     // Indices of new array to map to.
-    int w_range = idx_i * ws * ws + ws * idx_y + idx_x;
+    int w_range = idx_i * out_ht * out_wd + out_wd * (idx_y + offset) + idx_x + offset;
 
-    // Find limits of domain.
-    int inside_domain = (x >= 0 && x < wd && y >= 0 && y < ht);
-
-    if (inside_domain) {
-    // Apply the mapping.
-    output[w_range] = input[(y * wd + x)];
-    } else {output[w_range] = 0;}
+    // Apply the mapping, loading only the pixels inside the frame.
+    bool inside_domain = x >= 0 && x < wd && y >= 0 && y < ht;
+    output[w_range] = inside_domain ? __ldg(&input[y * wd + x]) : 0.0f;
 }
 
-__global__ void window_slice_deform(float *output, float *input, float *shift, float *strain, float dt, int deform,
-                    int ws, int spacing, int buffer_x, int buffer_y, int n_windows, int n, int wd, int ht)
+__global__ void window_slice_deform(float * __restrict__ output, const float * __restrict__ input,
+                    const float * __restrict__ shift_u, const float * __restrict__ shift_v,
+                    const float * __restrict__ strain, float dt, int deform, int ws, int spacing, int buffer_x,
+                    int buffer_y, int n_windows, int n, int wd, int ht, int out_ht, int out_wd, int offset)
 {
     // dt : factor to apply to the shift and strain tensors
     // wd : width (number of columns in the full image)
     // ht : height (number of rows in the full image)
+    // out_ht, out_wd : shape of each output window, which may be zero-padded
+    // offset : row and column of the output window where the interrogation window starts
     // x blocks are windows; y and z blocks are x and y dimensions, respectively.
     int idx_i = blockIdx.x;
     int idx_x = blockIdx.y * blockDim.x + threadIdx.x;
@@ -1265,8 +1542,8 @@ __global__ void window_slice_deform(float *output, float *input, float *shift, f
     if (idx_x >= ws || idx_y >= ws) {return;}
 
     // Get the shift values.
-    float u = shift[idx_i];
-    float v = shift[n_windows + idx_i];
+    float u = shift_u[idx_i];
+    float v = shift_v[idx_i];
     float dx;
     float dy;
 
@@ -1304,23 +1581,23 @@ __global__ void window_slice_deform(float *output, float *input, float *shift, f
     int y2 = y1 + 1;
 
     // Indices of image to map to.
-    int w_range = idx_i * ws * ws + ws * idx_y + idx_x;
-
-    // Find limits of domain.
-    int inside_domain = (x1 >= 0 && x2 < wd && y1 >= 0 && y2 < ht);
-    
-    if (inside_domain) {
-    // Apply the mapping.
-    output[w_range] = ((x2 - x) * (y2 - y) * input[(y1 * wd + x1)]  // f11
-                       + (x - x1) * (y2 - y) * input[(y1 * wd + x2)]  // f21
-                       + (x2 - x) * (y - y1) * input[(y2 * wd + x1)]  // f12
-                       + (x - x1) * (y - y1) * input[(y2 * wd + x2)]);  // f22
-    } else {output[w_range] = 0.0f;}
+    int w_range = idx_i * out_ht * out_wd + out_wd * (idx_y + offset) + idx_x + offset;
+
+    // Apply the mapping, loading only the pixels inside the frame.
+    bool inside_domain = x1 >= 0 && x2 < wd && y1 >= 0 && y2 < ht;
+    output[w_range] = inside_domain ? ((x2 - x) * (y2 - y) * __ldg(&input[y1 * wd + x1])  // f11
+                                       + (x - x1) * (y2 - y) * __ldg(&input[y1 * wd + x2])  // f21
+                                       + (x2 - x) * (y - y1) * __ldg(&input[y2 * wd + x1])  // f12
+                                       + (x - x1) * (y - y1) * __ldg(&input[y2 * wd + x2]))  // f22
+                                    : 0.0f;
 }
 """)
+_window_slice = mod_window_slice.get_function('window_slice').prepare('PPiiiiiiiiii')
+_window_slice_deform = mod_window_slice.get_function('window_slice_deform').prepare('PPPPPfiiiiiiiiiiii')
 
 
-def _gpu_window_slice(frame_d, field_shape, window_size, spacing, buffer, dt=0, shift_d=None, strain_d=None):
+def _gpu_window_slice(frame_d, field_shape, window_size, spacing, buffer, dt=0, shift_d=None, strain_d=None,
+                      fft_shape=None, offset=0, stream=None):
     """Creates a 3D array stack of all the interrogation windows using shift and strain.
 
     Parameters
@@ -1338,15 +1615,21 @@ def _gpu_window_slice(frame_d, field_shape, window_size, spacing, buffer, dt=0,
     dt : float, optional
         Number between -1 and 1 indicating the level of shifting/deform. E.g. 1 indicates shift by full amount, 0 is
         stationary. This is applied to the deformation in an analogous way.
-    shift_d : GPUArray, optional
-        3D float (2, m, n) ([du, dv]), shift of the second window.
+    shift_d : tuple of GPUArray, optional
+        (du, dv), 2D float (m, n), shift of the second window.
     strain_d : GPUArray, optional
         3D float (4, m, n) ([u_x, u_y, v_x, v_y]), strain rate tensor.
+    fft_shape : tuple or None, optional
+        Int (fft_ht, fft_wd), shape to zero-pad each window to. Windows are not padded if None.
+    offset : int, optional
+        Row and column of the padded window where the interrogation window is placed.
+    stream : Stream or None, optional
+        CUDA stream on which to launch the kernels.
 
     Returns
     -------
     GPUArray
-        3D float (n_windows, ht, wd), interrogation windows stacked in the first dimension.
+        3D float (n_windows, fft_ht, fft_wd), interrogation windows stacked in the first dimension.
 
     """
     _check_arrays(frame_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=2)
@@ -1361,143 +1644,116 @@ def _gpu_window_slice(frame_d, field_shape, window_size, spacing, buffer, dt=0,
     m, n = field_shape
     n_windows = m * n
 
-    win_d = gpuarray.empty((n_windows, window_size, window_size), dtype=DTYPE_f)
-
-    block_size = 8
-    grid_size = ceil(window_size / block_size)
+    if fft_shape is None:
+        out_ht = out_wd = window_size
+        win_d = gpuarray.empty((n_windows, out_ht, out_wd), dtype=DTYPE_f, allocator=_mem_pool.allocate)
+    else:
+        out_ht, out_wd = fft_shape
+        assert 0 <= offset and offset + window_size <= min(out_ht, out_wd)
+        # The padding is cleared on the same stream, since a memset on the default stream would serialize the frames.
+        win_d = gpuarray.empty((n_windows, out_ht, out_wd), dtype=DTYPE_f, allocator=_mem_pool.allocate)
+        cuda.memset_d32_async(win_d.gpudata, 0, win_d.size, stream)
+
+    # Rows of the window map to consecutive threads so that warps read contiguous pixels of the frame.
+    block_size_x = min(32, window_size)
+    block_size_y = 128 // block_size_x
+    grid_size_x = ceil(window_size / block_size_x)
+    grid_size_y = ceil(window_size / block_size_y)
     if shift_d is not None:
-        _check_arrays(shift_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=(2, m, n))
+        shift_u_d, shift_v_d = shift_d
+        _check_arrays(shift_u_d, shift_v_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=(m, n))
         do_deform = DTYPE_i(strain_d is not None)
         if not do_deform:
-            strain_d = gpuarray.zeros(1, dtype=DTYPE_i)
+            # The strain is not read when do_deform is 0.
+            strain_d = shift_u_d
         else:
             _check_arrays(strain_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=3)
-        window_slice = mod_window_slice.get_function('window_slice_deform')
-        window_slice(win_d, frame_d, shift_d, strain_d, DTYPE_f(dt), do_deform, DTYPE_i(window_size),
-                     DTYPE_i(spacing), buffer_x_i, buffer_y_i, DTYPE_i(n_windows), DTYPE_i(n), DTYPE_i(wd),
-                     DTYPE_i(ht), block=(block_size, block_size, 1), grid=(int(n_windows), grid_size, grid_size))
+        _window_slice_deform.prepared_async_call((int(n_windows), grid_size_x, grid_size_y),
+                                                 (block_size_x, block_size_y, 1), stream, win_d.gpudata,
+                                                 frame_d.gpudata, shift_u_d.gpudata, shift_v_d.gpudata,
+                                                 strain_d.gpudata, DTYPE_f(dt), do_deform, window_size, spacing,
+                                                 buffer_x_i, buffer_y_i, n_windows, n, wd, ht, out_ht, out_wd, offset)
     else:
-        window_slice = mod_window_slice.get_function('window_slice')
-        window_slice(win_d, frame_d, DTYPE_i(window_size), DTYPE_i(spacing), buffer_x_i, buffer_y_i, DTYPE_i(n),
-                     DTYPE_i(wd), DTYPE_i(ht), block=(block_size, block_size, 1),
-                     grid=(int(n_windows), grid_size, grid_size))
+        _window_slice.prepared_async_call((int(n_windows), grid_size_x, grid_size_y), (block_size_x, block_size_y, 1),
+                                          stream, win_d.gpudata, frame_d.gpudata, window_size, spacing, buffer_x_i,
+                                          buffer_y_i, n, wd, ht, out_ht, out_wd, offset)
 
     return win_d
 
 
 mod_norm = SourceModule("""
-__global__ void normalize(float *array, float *array_norm, float *mean, int window_size, int size)
-{
-    // global thread id for 1D grid of 2D blocks
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
-    if (t_idx >= size) {return;}
-
-    // indices for mean matrix
-    int w_idx = t_idx / window_size;
-
-    array_norm[t_idx] = array[t_idx] - mean[w_idx];
-}
-""")
-
-
-def _gpu_normalize_intensity(win_d):
-    """Remove the mean from each IW of a 3D stack of interrogation windows.
-
-    Parameters
-    ----------
-    win_d : GPUArray
-        3D float (n_windows, ht, wd), interrogation windows.
-
-    Returns
-    -------
-    GPUArray
-        3D float (n_windows, ht, wd), normalized intensities in the windows.
-
-    """
-    _check_arrays(win_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=3)
-    n_windows, ht, wd = win_d.shape
-    window_size = ht * wd
-    size = win_d.size
-
-    win_norm_d = gpuarray.zeros((n_windows, ht, wd), dtype=DTYPE_f)
-
-    mean_d = cumisc.mean(win_d.reshape(n_windows, int(window_size)), axis=1)
-
-    block_size = _BLOCK_SIZE
-    grid_size = ceil(size / block_size)
-    normalize = mod_norm.get_function('normalize')
-    normalize(win_d, win_norm_d, mean_d, DTYPE_i(window_size), DTYPE_i(size), block=(block_size, 1, 1),
-              grid=(grid_size, 1))
-
-    return win_norm_d
-
-
-mod_zp = SourceModule("""
-__global__ void zero_pad(float *array_zp, float *array, int fft_ht, int fft_wd, int ht, int wd, int dx, int dy)
+__global__ void normalize(float *array, int fft_ht, int fft_wd, int ht, int wd, int offset)
 {
-    // index, x blocks are windows; y and z blocks are x and y dimensions, respectively
-    int ind_i = blockIdx.x;
-    int ind_x = blockIdx.y * blockDim.x + threadIdx.x;
-    int ind_y = blockIdx.z * blockDim.y + threadIdx.y;
-
-    // get range of values to map
-    int data_range = ind_i * ht * wd + wd * ind_y + ind_x;
-    int zp_range = ind_i * fft_ht * fft_wd + fft_wd * (ind_y + dy) + ind_x + dx;
+    // array : input and output argument
+    // x blocks are windows; threads reduce over the points of a window.
+    __shared__ float s_sum[BLOCK_SIZE];
+    int t_idx = threadIdx.x;
+    int ws = ht * wd;
+    float *window = array + blockIdx.x * fft_ht * fft_wd + offset * fft_wd + offset;
+
+    // Sum the interrogation window, skipping the zero-padding.
+    float sum = 0.0f;
+    for (int i = t_idx; i < ws; i += BLOCK_SIZE) {sum += window[(i / wd) * fft_wd + i % wd];}
+    s_sum[t_idx] = sum;
+    __syncthreads();
+    for (int s = BLOCK_SIZE / 2; s > 0; s >>= 1) {
+        if (t_idx < s) {s_sum[t_idx] += s_sum[t_idx + s];}
+        __syncthreads();
+    }
 
-    // apply the map
-    array_zp[zp_range] = array[data_range];
+    // Subtract the mean.
+    float mean = s_sum[0] / ws;
+    for (int i = t_idx; i < ws; i += BLOCK_SIZE) {window[(i / wd) * fft_wd + i % wd] -= mean;}
 }
-""")
+""", options=['-DBLOCK_SIZE={}'.format(_REDUCTION_BLOCK_SIZE)])
+_normalize = mod_norm.get_function('normalize').prepare('Piiiii')
 
 
-def _gpu_zero_pad(win_d, fft_shape, extended_search_offset=0):
-    """Function that zero-pads an 3D stack of arrays for use with the scikit-cuda FFT function.
+def _gpu_normalize_intensity(win_d, window_shape=None, offset=0, stream=None):
+    """Remove the mean from each IW of a 3D stack of interrogation windows in-place.
 
     Parameters
     ----------
     win_d : GPUArray
-        3D float (n_windows, ht, wd), interrogation windows.
-    fft_shape : tuple
-        Int (ht, wd), shape to zero pad the date to.
-    extended_search_offset: int or tuple, optional
-        (offset_x, offset_y), offsets to the destination index in the padded array. Used for the extended search area
-        PIV method.
+        3D float (n_windows, fft_ht, fft_wd), interrogation windows, which may be zero-padded.
+    window_shape : tuple or None, optional
+        Int (ht, wd), shape of the interrogation windows inside the padding. Defaults to the shape of the windows.
+    offset : int, optional
+        Row and column of the padded windows where the interrogation windows start.
+    stream : Stream or None, optional
+        CUDA stream on which to launch the kernel.
 
     Returns
     -------
     GPUArray
-        3D float, windows which have been zero-padded.
+        3D float (n_windows, fft_ht, fft_wd), normalized intensities in the windows.
 
     """
     _check_arrays(win_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=3)
-    assert 0 <= extended_search_offset == int(extended_search_offset)
-    if isinstance(extended_search_offset, int):
-        offset_x_i = offset_y_i = DTYPE_i(extended_search_offset)
-    else:
-        offset_x_i, offset_y_i = DTYPE_i(extended_search_offset)
-    n_windows, wd, ht = win_d.shape
-    fft_ht_i, fft_wd_i = DTYPE_i(fft_shape)
-
-    win_zp_d = gpuarray.zeros((n_windows, *fft_shape), dtype=DTYPE_f)
+    n_windows, fft_ht, fft_wd = win_d.shape
+    ht, wd = window_shape if window_shape is not None else (fft_ht, fft_wd)
+    assert 0 <= offset and offset + ht <= fft_ht and offset + wd <= fft_wd
 
-    block_size = 8
-    grid_size = ceil(max(wd, ht) / block_size)
-    zero_pad = mod_zp.get_function('zero_pad')
-    zero_pad(win_zp_d, win_d, fft_ht_i, fft_wd_i, DTYPE_i(ht), DTYPE_i(wd), offset_x_i, offset_y_i,
-             block=(block_size, block_size, 1), grid=(n_windows, grid_size, grid_size))
+    block_size = _REDUCTION_BLOCK_SIZE
+    _normalize.prepared_async_call((n_windows, 1), (block_size, 1, 1), stream, win_d.gpudata, fft_ht, fft_wd, ht, wd,
+                                   offset)
 
-    return win_zp_d
+    return win_d
 
 
-def _gpu_cross_correlate(win_a_d, win_b_d):
+def _gpu_cross_correlate(win_a_d, win_b_d, stream_a=None, stream_b=None):
     """Returns circular cross-correlation between two stacks of interrogation windows.
 
-    The correlation function is computed using the correlation theorem.
+    The correlation function is computed using the correlation theorem. The output is fft-shifted, i.e. zero
+    displacement is at the center of each window. The shift is applied in the frequency domain, where it amounts to
+    negating every other coefficient in a checkerboard pattern, which requires the FFT dimensions to be even.
 
     Parameters
     ----------
     win_a_d, win_b_d : GPUArray
         3D float (n_windows, fft_ht, fft_wd), zero-padded interrogation windows.
+    stream_a, stream_b : Stream or None, optional
+        CUDA streams on which to compute the forward FFTs of each stack of windows.
 
     Returns
     -------
@@ -1508,110 +1764,189 @@ def _gpu_cross_correlate(win_a_d, win_b_d):
     _check_arrays(win_a_d, win_b_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=win_b_d.shape, ndim=3)
     n_windows, fft_ht, fft_wd = win_a_d.shape
 
-    win_cross_correlate_d = gpuarray.empty((n_windows, fft_ht, fft_wd), DTYPE_f)
-    win_a_fft_d = gpuarray.empty((n_windows, fft_ht, fft_wd // 2 + 1), DTYPE_c)
-    win_b_fft_d = gpuarray.empty((n_windows, fft_ht, fft_wd // 2 + 1), DTYPE_c)
+    win_cross_correlate_d = gpuarray.empty((n_windows, fft_ht, fft_wd), DTYPE_f, allocator=_mem_pool.allocate)
+    win_a_fft_d = gpuarray.empty((n_windows, fft_ht, fft_wd // 2 + 1), DTYPE_c, allocator=_mem_pool.allocate)
+    win_b_fft_d = gpuarray.empty((n_windows, fft_ht, fft_wd // 2 + 1), DTYPE_c, allocator=_mem_pool.allocate)
+
+    plan_a, plan_b, plan_inverse = _get_correlation_plans((fft_ht, fft_wd), n_windows, stream_a, stream_b)
 
     # Forward FFTs.
-    plan_forward = cufft.Plan((fft_ht, fft_wd), DTYPE_f, DTYPE_c, batch=n_windows)
-    cufft.fft(win_a_d, win_a_fft_d, plan_forward)
-    cufft.fft(win_b_d, win_b_fft_d, plan_forward)
+    cufft.fft(win_a_d, win_a_fft_d, plan_a)
+    cufft.fft(win_b_d, win_b_fft_d, plan_b)
 
-    # Multiply the FFTs.
-    win_a_fft_d = win_a_fft_d.conj()
-    win_fft_product_d = win_b_fft_d * win_a_fft_d
-    # win_fft_product_d = win_a_fft_d.conj() * win_b_fft_d
+    # Multiply the FFTs in-place, applying the shift. This runs on the default stream, which waits for both streams.
+    _correlation_product(win_b_fft_d, win_a_fft_d, fft_ht, fft_wd // 2 + 1)
 
     # Inverse transform.
-    plan_inverse = cufft.Plan((fft_ht, fft_wd), DTYPE_c, DTYPE_f, batch=n_windows)
-    cufft.ifft(win_fft_product_d, win_cross_correlate_d, plan_inverse, True)
+    cufft.ifft(win_b_fft_d, win_cross_correlate_d, plan_inverse, True)
 
     return win_cross_correlate_d
 
 
-mod_index_update = SourceModule("""
-__global__ void window_index_f(float *dest, float *src, int *indices, int ws, int n_windows)
-{
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
-    if (t_idx >= n_windows) {return;}
-
-    dest[t_idx] = src[t_idx * ws + indices[t_idx]];
-}
-""")
+# Computes b = conj(a) * b * (-1)^(row + col) over stacks of half spectra of shape (ht, wd).
+_correlation_product = ElementwiseKernel(
+    'pycuda::complex<float> *b, pycuda::complex<float> *a, unsigned int ht, unsigned int wd',
+    """
+    unsigned int row = (i / wd) % ht;
+    unsigned int col = i % wd;
+    float sign = ((row + col) & 1) ? -1.0f : 1.0f;
+    pycuda::complex<float> a_i = a[i];
+    pycuda::complex<float> b_i = b[i];
+    b[i] = pycuda::complex<float>(sign * (a_i.real() * b_i.real() + a_i.imag() * b_i.imag()),
+                                  sign * (a_i.real() * b_i.imag() - a_i.imag() * b_i.real()));
+    """,
+    'correlation_product')
 
 
-def _gpu_window_index_f(correlation_d, indices_d):
-    """Returns the values of the peaks from the 2D correlation.
+def _get_fft_plan(shape, in_dtype, out_dtype, batch, stream=None):
+    """Returns a cached cuFFT plan, creating it on first use.
 
     Parameters
     ----------
-    correlation_d : GPUArray
-        2D float (n_windows, m * n), correlation values of each window.
-    indices_d : GPUArray
-        1D int (n_windows,), indexes of the peaks.
+    shape : tuple
+        Int, shape of each transform.
+    in_dtype, out_dtype : dtype
+        Input and output data types of the transform.
+    batch : int
+        Number of transforms to compute at once.
+    stream : Stream or None, optional
+        CUDA stream that the plan executes on.
 
     Returns
     -------
-    GPUArray
-        1D float (m * n)
+    Plan
 
     """
-    _check_arrays(correlation_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=2)
-    n_windows, window_size = correlation_d.shape
-    _check_arrays(indices_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=(n_windows,), ndim=1)
+    key = (tuple(shape), np.dtype(in_dtype), np.dtype(out_dtype), batch, stream)
+    plan = _fft_plans.get(key)
+    if plan is None:
+        plan = _fft_plans[key] = cufft.Plan(shape, in_dtype, out_dtype, batch=batch, stream=stream)
 
-    peak_d = gpuarray.empty(n_windows, dtype=DTYPE_f)
+    return plan
 
-    block_size = _BLOCK_SIZE
-    grid_size = ceil(n_windows / block_size)
-    index_update = mod_index_update.get_function('window_index_f')
-    index_update(peak_d, correlation_d, indices_d, DTYPE_i(window_size), DTYPE_i(n_windows), block=(block_size, 1, 1),
-                 grid=(grid_size, 1))
 
-    return peak_d
+def _get_correlation_plans(fft_shape, n_windows, stream_a=None, stream_b=None):
+    """Returns the cached forward plans for each stream and the inverse plan used by the cross-correlation.
 
+    Each stream needs its own forward plan, since a plan's work area cannot be shared by concurrent transforms.
 
-def _find_peak(correlation_d):
-    """Returns the row and column of the highest peak in correlation function.
+    """
+    plan_a = _get_fft_plan(fft_shape, DTYPE_f, DTYPE_c, n_windows, stream=stream_a)
+    plan_b = _get_fft_plan(fft_shape, DTYPE_f, DTYPE_c, n_windows, stream=stream_b)
+    plan_inverse = _get_fft_plan(fft_shape, DTYPE_c, DTYPE_f, n_windows)
 
-    Parameters
-    ----------
-    correlation_d : GPUArray
-        3D float, image of the correlation function.
+    return plan_a, plan_b, plan_inverse
 
-    Returns
-    -------
-    peak_idx_d : GPUArray
-        1D int, index of peak location in reshaped correlation function.
 
-    """
-    n_windows, wd, ht = correlation_d.shape
+def clear_fft_plan_cache():
+    """Frees the cached cuFFT plans and their work areas, e.g. before processing images of a different size."""
+    _fft_plans.clear()
+    _smoothn_fft_plans.clear()
+
+
+mod_find_peak = SourceModule("""
+#include <math.h>
+
+__global__ void find_peak(float *peak, int *row, int *col, const float * __restrict__ corr,
+                          const int * __restrict__ row_p, const int * __restrict__ col_p, int mask_w, int ht, int wd)
+{
+    // peak, row, col : output arguments
+    // row_p, col_p : points within mask_w of these are read as zero, unless mask_w is negative
+    // x blocks are windows; threads reduce over the points of a window.
+    __shared__ float s_value[BLOCK_SIZE];
+    __shared__ int s_idx[BLOCK_SIZE];
+    int w_idx = blockIdx.x;
+    int t_idx = threadIdx.x;
+    int ws = ht * wd;
+    const float *window = corr + w_idx * ws;
+    int mask_row = mask_w >= 0 ? row_p[w_idx] : 0;
+    int mask_col = mask_w >= 0 ? col_p[w_idx] : 0;
+
+    // Each thread finds the first maximum among the points it strides over.
+    float max_value = -INFINITY;
+    int max_idx = ws;
+    for (int i = t_idx; i < ws; i += BLOCK_SIZE) {
+        bool masked = abs(i / wd - mask_row) <= mask_w && abs(i % wd - mask_col) <= mask_w;
+        float value = masked ? 0.0f : window[i];
+        if (value > max_value) {max_value = value; max_idx = i;}
+    }
+    s_value[t_idx] = max_value;
+    s_idx[t_idx] = max_idx;
+    __syncthreads();
+
+    // Tree reduction, keeping the lowest index among equal values.
+    for (int s = BLOCK_SIZE / 2; s > 0; s >>= 1) {
+        if (t_idx < s) {
+            float other_value = s_value[t_idx + s];
+            int other_idx = s_idx[t_idx + s];
+            if (other_value > s_value[t_idx] || (other_value == s_value[t_idx] && other_idx < s_idx[t_idx])) {
+                s_value[t_idx] = other_value;
+                s_idx[t_idx] = other_idx;
+            }
+        }
+        __syncthreads();
+    }
 
-    corr_reshape_d = correlation_d.reshape(n_windows, wd * ht)
-    peak_idx_d = cumisc.argmax(corr_reshape_d, axis=1).astype(DTYPE_i)
+    // Use the center of the window if the correlation peak is not positive.
+    if (t_idx == 0) {
+        float peak_value = s_value[0];
+        int idx = s_idx[0];
+        peak[w_idx] = peak_value;
+        row[w_idx] = peak_value > 0.0f ? idx / wd : ht / 2;
+        col[w_idx] = peak_value > 0.0f ? idx % wd : wd / 2;
+    }
+}
+""", options=['-DBLOCK_SIZE={}'.format(_REDUCTION_BLOCK_SIZE)])
+_find_peak_f = mod_find_peak.get_function('find_peak').prepare('PPPPPPiii')
 
-    return peak_idx_d
 
+def _find_peak(correlation_d, row_peak_d=None, col_peak_d=None, mask_width=None, stream=None):
+    """Returns the value, row and column of the highest peak in the correlation function.
 
-def _get_peak(correlation_d, peak_idx_d):
-    """Returns the value of the highest peak in correlation function.
+    Windows whose peak is not positive are assigned the center of the correlation window. If a mask width is given,
+    the points around the given peaks are treated as zero, which finds the second peak without copying the data.
 
     Parameters
     ----------
-    peak_idx_d : GPUArray
-        1D int, image of the correlation function.
+    correlation_d : GPUArray
+        3D float (n_windows, ht, wd), image of the correlation function.
+    row_peak_d, col_peak_d : GPUArray or None, optional
+        1D int (n_windows,), position of the peaks to mask.
+    mask_width : int or None, optional
+        Half size of the region around the given peaks to ignore.
+    stream : Stream or None, optional
+        Stream to launch the kernel on.
 
     Returns
     -------
-    GPUArray
-        1D int, flattened index of corr peak.
+    peak_d : GPUArray
+        1D float (n_windows,), value of the peaks.
+    row_d, col_d : GPUArray
+        1D int (n_windows,), row and column of the peaks.
 
     """
-    n_windows, wd, ht = correlation_d.shape
-    corr_reshape_d = correlation_d.reshape(n_windows, wd * ht)
-    peak_value_d = _gpu_window_index_f(corr_reshape_d, peak_idx_d)
+    _check_arrays(correlation_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=3)
+    n_windows, ht, wd = correlation_d.shape
+    if mask_width is not None:
+        _check_arrays(row_peak_d, col_peak_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=(n_windows,))
+        assert 0 <= mask_width < int(min(ht, wd) / 2), \
+            'Mask width must be integer from 0 and to less than half the correlation window height or width.' \
+            'Recommended value is 2.'
+        row_peak_ptr, col_peak_ptr = row_peak_d.gpudata, col_peak_d.gpudata
+    else:
+        row_peak_ptr = col_peak_ptr = np.intp(0)
+        mask_width = -1
+
+    peak_d = gpuarray.empty(n_windows, dtype=DTYPE_f, allocator=_mem_pool.allocate)
+    row_d = gpuarray.empty(n_windows, dtype=DTYPE_i, allocator=_mem_pool.allocate)
+    col_d = gpuarray.empty(n_windows, dtype=DTYPE_i, allocator=_mem_pool.allocate)
 
-    return peak_value_d
+    block_size = _REDUCTION_BLOCK_SIZE
+    _find_peak_f.prepared_async_call((n_windows, 1), (block_size, 1, 1), stream, peak_d.gpudata, row_d.gpudata,
+                                     col_d.gpudata, correlation_d.gpudata, row_peak_ptr, col_peak_ptr, int(mask_width),
+                                     ht, wd)
+
+    return peak_d, row_d, col_d
 
 
 mod_subpixel_approximation = SourceModule("""
@@ -1707,6 +2042,8 @@ __global__ void centroid(float *row_sp, float *col_sp, int *row_p, int *col_p, f
     } else {col_sp[w_idx] = col;}
 }
 """)
+_subpixel_approximations = {method: mod_subpixel_approximation.get_function(method).prepare('PPPPPiiii')
+                             for method in ALLOWED_SUBPIXEL_METHODS}
 
 
 def _gpu_subpixel_approximation(correlation_d, row_peak_d, col_peak_d, method):
@@ -1734,26 +2071,14 @@ def _gpu_subpixel_approximation(correlation_d, row_peak_d, col_peak_d, method):
     n_windows, ht, wd = correlation_d.shape
     window_size = ht * wd
 
-    row_sp_d = gpuarray.empty_like(row_peak_d, dtype=DTYPE_f)
-    col_sp_d = gpuarray.empty_like(col_peak_d, dtype=DTYPE_f)
+    row_sp_d = gpuarray.empty(row_peak_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
+    col_sp_d = gpuarray.empty(col_peak_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(n_windows / block_size)
-    if method == 'gaussian':
-        gaussian_approximation = mod_subpixel_approximation.get_function('gaussian')
-        gaussian_approximation(row_sp_d, col_sp_d, row_peak_d, col_peak_d, correlation_d, DTYPE_i(n_windows),
-                               DTYPE_i(ht), DTYPE_i(wd), DTYPE_i(window_size), block=(block_size, 1, 1),
-                               grid=(grid_size, 1))
-    elif method == 'parabolic':
-        parabolic_approximation = mod_subpixel_approximation.get_function('parabolic')
-        parabolic_approximation(row_sp_d, col_sp_d, row_peak_d, col_peak_d, correlation_d, DTYPE_i(n_windows),
-                                DTYPE_i(ht), DTYPE_i(wd), DTYPE_i(window_size), block=(block_size, 1, 1),
-                                grid=(grid_size, 1))
-    else:
-        centroid_approximation = mod_subpixel_approximation.get_function('centroid')
-        centroid_approximation(row_sp_d, col_sp_d, row_peak_d, col_peak_d, correlation_d, DTYPE_i(n_windows),
-                               DTYPE_i(ht), DTYPE_i(wd), DTYPE_i(window_size), block=(block_size, 1, 1),
-                               grid=(grid_size, 1))
+    _subpixel_approximations[method].prepared_call((grid_size, 1), (block_size, 1, 1), row_sp_d.gpudata,
+                                                   col_sp_d.gpudata, row_peak_d.gpudata, col_peak_d.gpudata,
+                                                   correlation_d.gpudata, n_windows, ht, wd, window_size)
 
     return row_sp_d, col_sp_d
 
@@ -1799,69 +2124,10 @@ def _peak2peak(corr_peak1_d, corr_peak2_d):
     return sig2noise_d
 
 
-mod_mask_peak = SourceModule("""
-__global__ void mask_peak(float *corr, int *row_p, int *col_p, int mask_w, int ht, int wd, int mask_dim, int size)
-{
-    // x blocks are windows; y and z blocks are x and y dimensions, respectively.
-    int idx_i = blockIdx.x;
-    int idx_x = blockIdx.y * blockDim.x + threadIdx.x;
-    int idx_y = blockIdx.z * blockDim.y + threadIdx.y;
-    if (idx_x >= mask_dim || idx_y >= mask_dim) {return;}
-
-    // Get the mapping.
-    int row = row_p[idx_i] - mask_w + idx_y;
-    int col = col_p[idx_i] - mask_w + idx_x;
-
-    // Mask only if inside window domain.
-    if (row >= 0 && row < ht && col >= 0 && col < wd) {
-        // Mask the point.
-        corr[idx_i * size + row * wd + col] = 0.0f;
-    }
-}
-""")
-
-
-def _gpu_mask_peak(correlation_positive_d, row_peak_d, col_peak_d, mask_width):
-    """Returns correlation windows with points around peak masked.
-
-    Parameters
-    ----------
-    correlation_positive_d : GPUArray.
-        3D float (n_windows, fft_wd, fft_ht), correlation data with negative values removed.
-    row_peak_d, col_peak_d : GPUArray
-        1D int (n_windows,), position of the peaks.
-    mask_width : int
-        Half size of the region around the first correlation peak to ignore for finding the second peak.
-
-    Returns
-    -------
-    GPUArray
-        3D float.
-
-    """
-    _check_arrays(correlation_positive_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, ndim=3)
-    n_windows, ht, wd = correlation_positive_d.shape
-    _check_arrays(row_peak_d, col_peak_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=(n_windows,))
-    window_size = ht * wd
-    assert 0 <= mask_width < int(min(ht, wd) / 2), \
-        'Mask width must be integer from 0 and to less than half the correlation window height or width.' \
-        'Recommended value is 2.'
-    mask_dim_i = DTYPE_i(mask_width * 2 + 1)
-
-    correlation_masked_d = correlation_positive_d.copy()
-
-    block_size = 8
-    grid_size = ceil(mask_dim_i / block_size)
-    fft_shift = mod_mask_peak.get_function('mask_peak')
-    fft_shift(correlation_masked_d, row_peak_d, col_peak_d, DTYPE_i(mask_width), DTYPE_i(ht), DTYPE_i(wd), mask_dim_i,
-              DTYPE_i(window_size), block=(block_size, block_size, 1), grid=(n_windows, grid_size, grid_size))
-
-    return correlation_masked_d
-
-
 mod_correlation_rms = SourceModule("""
-__global__ void correlation_rms(float *corr, float *corr_p, int ht, int wd, int size)
+__global__ void correlation_rms(float *corr_masked, const float *corr, const float *corr_p, int ht, int wd, int size)
 {
+    // corr_masked : output argument
     // x blocks are windows; y and z blocks are x and y dimensions, respectively.
     int idx_i = blockIdx.x;
     int idx_x = blockIdx.y * blockDim.x + threadIdx.x;
@@ -1870,9 +2136,11 @@ __global__ void correlation_rms(float *corr, float *corr_p, int ht, int wd, int
     int idx = idx_i * size + idx_y * wd + idx_x;
 
     // Mask the point if its value greater than the half-peak value.
-    if (corr[idx] >= corr_p[idx_i] / 2.0f) {corr[idx] = 0.0f;}
+    float value = corr[idx];
+    corr_masked[idx] = value < corr_p[idx_i] / 2.0f ? value : 0.0f;
 }
 """)
+_correlation_rms = mod_correlation_rms.get_function('correlation_rms').prepare('PPPiii')
 
 
 def _gpu_mask_rms(correlation_positive_d, corr_peak_d):
@@ -1896,81 +2164,99 @@ def _gpu_mask_rms(correlation_positive_d, corr_peak_d):
     _check_arrays(corr_peak_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=(n_windows,))
     window_size = ht * wd
 
-    correlation_masked_d = correlation_positive_d.copy()
+    correlation_masked_d = gpuarray.empty((n_windows, ht, wd), dtype=DTYPE_f, allocator=_mem_pool.allocate)
 
-    block_size = 8
-    grid_size = ceil(max(ht, wd) / block_size)
-    fft_shift = mod_correlation_rms.get_function('correlation_rms')
-    fft_shift(correlation_masked_d, corr_peak_d, DTYPE_i(ht), DTYPE_i(wd), DTYPE_i(window_size),
-              block=(block_size, block_size, 1), grid=(n_windows, grid_size, grid_size))
+    # Rows of the window map to consecutive threads so that warps access contiguous memory.
+    block_size_x = min(32, wd)
+    block_size_y = 256 // block_size_x
+    grid_size_x = ceil(wd / block_size_x)
+    grid_size_y = ceil(ht / block_size_y)
+    _correlation_rms.prepared_call((n_windows, grid_size_x, grid_size_y), (block_size_x, block_size_y, 1),
+                                   correlation_masked_d.gpudata, correlation_positive_d.gpudata, corr_peak_d.gpudata,
+                                   ht, wd, window_size)
 
     return correlation_masked_d
 
 
-def _get_shift(u_d, v_d):
-    """Returns the combined shift array."""
-    _check_arrays(u_d, v_d, array_type=gpuarray.GPUArray, shape=u_d.shape, dtype=DTYPE_f, ndim=2)
-    m, n = u_d.shape
-
-    shift_d = gpuarray.empty((2, m, n), dtype=DTYPE_f)
-    shift_d[0, :, :] = u_d
-    shift_d[1, :, :] = v_d
-    # shift_d = gpuarray.stack(dp_x_d, dp_y_d, axis=0)  # This should work in latest version of PyCUDA.
-
-    return shift_d
-
-
 mod_update = SourceModule("""
-__global__ void update_values(float *f_new, float *f_old, float *peak, int *mask, int size)
+__global__ void update_values(float *u_new, float *v_new, const float *dp_u, const float *dp_v, const float *u_peak,
+                    const float *v_peak, const int *mask, int size)
 {
-    // u_new : output argument
+    // u_new, v_new : output arguments
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
-    f_new[t_idx] = (f_old[t_idx] + peak[t_idx]) * (1 - mask[t_idx]);
+    float not_masked = 1 - mask[t_idx];
+    u_new[t_idx] = (dp_u[t_idx] + u_peak[t_idx]) * not_masked;
+    v_new[t_idx] = (dp_v[t_idx] + v_peak[t_idx]) * not_masked;
 }
 """)
+_update_values = mod_update.get_function('update_values').prepare('PPPPPPPi')
 
 
-def _gpu_update_field(dp_d, peak_d, mask_d):
+def _gpu_update_field(dp_u_d, dp_v_d, u_peak_d, v_peak_d, mask_d):
     """Returns updated velocity field values with masking.
 
     Parameters
     ----------
-    dp_d : GPUArray.
+    dp_u_d, dp_v_d : GPUArray.
         nD float, predicted displacement.
-    peak_d : GPUArray
+    u_peak_d, v_peak_d : GPUArray
         nD float, location of peaks.
     mask_d : GPUArray
         nD int, mask.
 
     Returns
     -------
-    GPUArray
+    u_d, v_d : GPUArray
         nD float.
 
     """
-    _check_arrays(dp_d, peak_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, size=dp_d.size)
-    _check_arrays(mask_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, size=dp_d.size)
-    size = dp_d.size
+    _check_arrays(dp_u_d, dp_v_d, u_peak_d, v_peak_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, size=dp_u_d.size)
+    _check_arrays(mask_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, size=dp_u_d.size)
+    size = dp_u_d.size
 
-    f_d = gpuarray.empty_like(dp_d, dtype=DTYPE_f)
+    u_d = gpuarray.empty(dp_u_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
+    v_d = gpuarray.empty(dp_v_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    update_values = mod_update.get_function('update_values')
-    update_values(f_d, dp_d, peak_d, mask_d, DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+    _update_values.prepared_call((grid_size, 1), (block_size, 1, 1), u_d.gpudata, v_d.gpudata, dp_u_d.gpudata,
+                                 dp_v_d.gpudata, u_peak_d.gpudata, v_peak_d.gpudata, mask_d.gpudata, size)
+
+    return u_d, v_d
 
-    return f_d
 
+# Takes both velocity components from the replacement fields at the validation locations.
+_replace_vectors = ElementwiseKernel(
+    'float *u_val, float *v_val, const int *val_locations, const float *u_rep, const float *v_rep, const float *u, '
+    'const float *v',
+    """
+    int val = val_locations[i];
+    u_val[i] = val ? u_rep[i] : u[i];
+    v_val[i] = val ? v_rep[i] : v[i];
+    """,
+    'replace_vectors')
+
+
+def _gpu_replace_field(u_d, v_d, u_rep_d, v_rep_d, val_locations_d):
+    """Returns the velocity fields with the vectors at the validation locations replaced."""
+    _check_arrays(u_d, v_d, u_rep_d, v_rep_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=u_d.shape)
+    _check_arrays(val_locations_d, array_type=gpuarray.GPUArray, dtype=DTYPE_i, shape=u_d.shape)
+
+    u_val_d = gpuarray.empty(u_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
+    v_val_d = gpuarray.empty(u_d.shape, dtype=DTYPE_f, allocator=_mem_pool.allocate)
+    _replace_vectors(u_val_d, v_val_d, val_locations_d, u_rep_d, v_rep_d, u_d, v_d)
 
-def _interpolate_replace(x0_d, y0_d, x1_d, y1_d, f0_d, f1_d, val_locations_d, mask_d=None):
+    return u_val_d, v_val_d
+
+
+def _interpolate_replace(x0_d, y0_d, x1_d, y1_d, f0_d, f1_d, val_locations_d, mask_d=None, stream=None):
     """Replaces the invalid vectors by interpolating another field."""
     _check_arrays(val_locations_d, array_type=gpuarray.GPUArray, shape=f1_d.shape, ndim=2)
 
-    f1_val_d = gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=mask_d)
-
-    # Replace vectors at validation locations.
-    f1_val_d = gpuarray.if_positive(val_locations_d, f1_val_d, f1_d)
+    # The interpolation and the replacement at the validation locations are done in one pass.
+    f1_val_d = _gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d, mask_d=mask_d, val_locations_d=val_locations_d,
+                                f1_d=f1_d, stream=stream)
 
     return f1_val_d
@@ -18,6 +18,7 @@ import pycuda.autoinit
 import pycuda.gpuarray as gpuarray
 import pycuda.cumath as cumath
 from pycuda.compiler import SourceModule
+from pycuda.elementwise import ElementwiseKernel
 
 from openpiv.gpu_misc import _check_arrays
 
@@ -37,15 +38,18 @@ ERR_P = 0.1
 N_P0 = 10
 COARSE_COEFFICIENTS = 10
 WEIGHT_METHODS = {'bisquare', 'talworth', 'cauchy'}
+_BLOCK_SIZE = 256
 
 
-def gpu_smoothn(*y_dl, **kwargs):
+def gpu_smoothn(*y_dl, out=None, **kwargs):
     """Smooths a scalar field stored as a GPUArray.
 
     Parameters
     ----------
     y_dl : GPUArray
         nD float, field to be smoothed.
+    out : GPUArray or list, optional
+        nD float, same size as y_d. Arrays to write the smoothed fields into, instead of allocating new ones.
 
     Returns
     -------
@@ -55,6 +59,20 @@ def gpu_smoothn(*y_dl, **kwargs):
     """
     _check_arrays(*y_dl, array_type=gpuarray.GPUArray, dtype=DTYPE_f)
     n = len(y_dl)
+    out_dl = None
+    if out is not None:
+        out_dl = [out] if n == 1 else list(out)
+        _check_arrays(*out_dl, array_type=gpuarray.GPUArray, dtype=DTYPE_f, shape=y_dl[0].shape)
+        assert len(out_dl) == n, 'out must have one array for each field.'
+
+    # With a given smoothing parameter and no weights, the smoothing is a single filter in the DCT domain, which is
+    # applied without copying the data to the host.
+    if _is_direct_smoothing(y_dl, **kwargs):
+        _check_smooth_order_spacing(kwargs.get('smooth_order', 2), kwargs.get('spacing'), y_dl[0].ndim)
+        z_dl = _gpu_smooth_direct(y_dl, kwargs['s'], kwargs.get('smooth_order', 2), kwargs.get('spacing'),
+                                  out_dl=out_dl)
+
+        return z_dl[0] if n == 1 else z_dl
 
     # Get data from GPUArrays.
     y = [y_d.get() for y_d in y_dl]
@@ -63,12 +81,15 @@ def gpu_smoothn(*y_dl, **kwargs):
             kwargs[key] = value.get()
 
     z = smoothn(*y, **kwargs)[0]
-    if n == 1:
-        z_dl = gpuarray.to_gpu(z)
+    z = [z] if n == 1 else z
+    if out_dl is not None:
+        for out_d, array in zip(out_dl, z):
+            out_d.set(array.astype(DTYPE_f, copy=False))
+        z_dl = out_dl
     else:
         z_dl = [gpuarray.to_gpu(array) for array in z]
 
-    return z_dl
+    return z_dl[0] if n == 1 else z_dl
 
 
 def smoothn(*y, mask=None, w=None, s=None, robust=False, z0=None, max_iter=100, tol_z=1e-3, weight_method='bisquare',
@@ -153,8 +174,7 @@ def smoothn(*y, mask=None, w=None, s=None, robust=False, z0=None, max_iter=100,
     weight_method = weight_method.lower()
     if weight_method not in WEIGHT_METHODS:
         raise ValueError('max_iter must be a number.')
-    if int(smooth_order) != smooth_order not in {0, 1, 2}:
-        raise ValueError('smooth_order must be 0, 1 or 2.')
+    _check_smooth_order_spacing(smooth_order, spacing, y_ndim)
 
     # Get mask.
     is_masked_array = False
@@ -214,11 +234,6 @@ def smoothn(*y, mask=None, w=None, s=None, robust=False, z0=None, max_iter=100,
 
     # Get spacing.
     if spacing is not None:
-        spacing = np.array(spacing)
-        if spacing.size != y_ndim:
-            raise ValueError('spacing must be either None or an array-like with size == y.ndim')
-        if np.any(spacing < 0):
-            raise ValueError('spacing must all be greater than zero.')
         spacing = np.array(spacing) / np.amax(spacing)
     else:
         spacing = np.ones(y_ndim)
@@ -314,6 +329,19 @@ def smoothn(*y, mask=None, w=None, s=None, robust=False, z0=None, max_iter=100,
     return z, s
 
 
+# cuFFT plans keyed by (size, input dtype, output dtype, batch), since the smoothing repeats the same transforms.
+_fft_plans = {}
+
+
+def _get_fft_plan(n, in_dtype, out_dtype, batch):
+    """Returns a cached plan for a batch of 1D transforms of size n."""
+    key = (n, np.dtype(in_dtype), np.dtype(out_dtype), batch)
+    if key not in _fft_plans:
+        _fft_plans[key] = cufft.Plan((n,), in_dtype, out_dtype, batch=batch)
+
+    return _fft_plans[key]
+
+
 def gpu_fft(y_d, norm='backward', full_frequency=False):
     """Returns the 1D FFT of the input.
 
@@ -339,7 +367,7 @@ def gpu_fft(y_d, norm='backward', full_frequency=False):
     scale = norm == 'forward'
     y_fft_d = gpuarray.empty((m, n // 2 + 1), dtype=DTYPE_c)
 
-    plan_forward = cufft.Plan((n,), DTYPE_f, DTYPE_c, batch=m)
+    plan_forward = _get_fft_plan(n, DTYPE_f, DTYPE_c, m)
     cufft.fft(y_d, y_fft_d, plan_forward, scale=scale)
 
     if norm == 'ortho':
@@ -384,7 +412,7 @@ def gpu_ifft(y_d, norm='backward', inverse_width=None, full_frequency=False):
 
     y_ifft_d = gpuarray.empty((m, inverse_width), dtype=DTYPE_f)
 
-    plan_inverse = cufft.Plan((inverse_width,), DTYPE_c, DTYPE_f, batch=m)
+    plan_inverse = _get_fft_plan(inverse_width, DTYPE_c, DTYPE_f, m)
     cufft.ifft(y_d, y_ifft_d, plan_inverse, scale=scale)
 
     if norm == 'ortho':
@@ -393,6 +421,49 @@ def gpu_ifft(y_d, norm='backward', inverse_width=None, full_frequency=False):
     return y_ifft_d
 
 
+# W-coefficients from Makhoul (1980), cached by transform size and normalization.
+_dct_weights = {}
+_idct_weights = {}
+
+
+def _get_dct_weights(n, norm):
+    """Returns the real and imaginary parts of the W-coefficients of the forward DCT."""
+    key = (n, norm)
+    if key not in _dct_weights:
+        normal_factor = DTYPE_f(1 / n) if norm == 'forward' else DTYPE_f(2)
+        k = np.arange(n // 2 + 1, dtype=DTYPE_f)
+        _dct_weights[key] = (gpuarray.to_gpu(np.cos(DTYPE_f(-np.pi) * k / DTYPE_f(2 * n)) * normal_factor),
+                             gpuarray.to_gpu(np.sin(DTYPE_f(np.pi) * k / DTYPE_f(2 * n)) * normal_factor))
+
+    return _dct_weights[key]
+
+
+def _get_idct_weights(n, norm):
+    """Returns the W-coefficients of the inverse DCT."""
+    key = (n, norm)
+    if key not in _idct_weights:
+        normal_factor = DTYPE_f(1) if norm == 'forward' else DTYPE_f(0.5)
+        k = np.arange(n // 2 + 1, dtype=DTYPE_f)
+        _idct_weights[key] = gpuarray.to_gpu(np.exp(DTYPE_c(1j * np.pi) * k / DTYPE_f(2 * n)) * normal_factor)
+
+    return _idct_weights[key]
+
+
+# Combines the half spectrum with the twiddle factors into the DCT, writing the positive frequencies to the first
+# freq_width columns of each row and the negative frequencies, flipped, to the rest.
+_dct_output = ElementwiseKernel(
+    'float *dest, pycuda::complex<float> *y_fft, float *w_real, float *w_imag, int wd, int freq_width',
+    """
+    int row = i / wd;
+    int col = i % wd;
+    int k = (col < freq_width) ? col : wd - col;
+    pycuda::complex<float> f = y_fft[row * freq_width + k];
+    dest[i] = (col < freq_width) ? f.real() * w_real[k] + f.imag() * w_imag[k]
+                                 : f.real() * w_imag[k] - f.imag() * w_real[k];
+    """,
+    'dct_output')
+
+
 def gpu_dct(y_d, norm='backward'):
     assert y_d.dtype == DTYPE_f
     if y_d.ndim == 1:
@@ -400,31 +471,16 @@ def gpu_dct(y_d, norm='backward'):
     m, n = y_d.shape
     assert n >= 2
 
-    normal_factor = DTYPE_f(1 / n) if norm == 'forward' else DTYPE_f(2)
-
     freq_width = n // 2 + 1
-
-    # W-coefficients from Makhoul.
-    w_real_d = gpuarray.to_gpu(np.cos(DTYPE_f(-np.pi) * np.arange(freq_width, dtype=DTYPE_f) / DTYPE_f(2 * n))
-                               * normal_factor)
-    w_imag_d = gpuarray.to_gpu(np.sin(DTYPE_f(np.pi) * np.arange(freq_width, dtype=DTYPE_f) / DTYPE_f(2 * n))
-                               * normal_factor)
+    w_real_d, w_imag_d = _get_dct_weights(n, norm)
 
     # Extend the fft output rather than zero-pad.
     data_d = _dct_order(y_d, 'forward')
     fft_data_d = gpu_fft(data_d, norm='backward', full_frequency=False)
-    fft_data_real_d = fft_data_d.real
-    fft_data_imag_d = fft_data_d.imag
 
-    # This could be done by a kernel to save two array definitions.
-    dct_positive_d = (cumisc.multiply(fft_data_real_d, w_real_d) + cumisc.multiply(fft_data_imag_d, w_imag_d))
-    dct_negative_d2 = (cumisc.multiply(fft_data_real_d, w_imag_d) - cumisc.multiply(fft_data_imag_d, w_real_d))
+    # The two halves of the DCT are written directly into the output.
     y_dct_d = gpuarray.empty((m, n), dtype=DTYPE_f)
-    y_dct_d[:, :freq_width] = dct_positive_d
-    y_dct_d[:, freq_width:] = _flip_frequency_real(dct_negative_d2, n - freq_width, offset=1 - n % 2)
-
-    # Use this after the next release of PyCUDA (2022) and after testing:
-    # y_dct_d = gpuarray.concatenate(dct_positive_d, dct_negative_d2, axis=0)
+    _dct_output(y_dct_d, fft_data_d, w_real_d, w_imag_d, n, freq_width)
 
     if norm == 'ortho':
         a = np.empty((n,), dtype=DTYPE_f)
@@ -437,6 +493,18 @@ def gpu_dct(y_d, norm='backward'):
     return y_dct_d
 
 
+# Builds the input of the inverse FFT, (y - j * y_flipped) * w, reading the first freq_width columns of each row of y.
+_idct_input = ElementwiseKernel(
+    'pycuda::complex<float> *dest, float *y, pycuda::complex<float> *w, int wd, int freq_width',
+    """
+    int row = i / freq_width;
+    int col = i % freq_width;
+    float y_flipped = (col > 0) ? y[row * wd + wd - col] : 0.0f;
+    dest[i] = pycuda::complex<float>(y[row * wd + col], -y_flipped) * w[col];
+    """,
+    'idct_input')
+
+
 def gpu_idct(y_d, norm='backward'):
     """Returns the 1D, type-II, inverse DCT of the input.
 
@@ -459,16 +527,14 @@ def gpu_idct(y_d, norm='backward'):
     assert n >= 2
     scale = norm == 'backward'
     freq_width = n // 2 + 1
-    normal_factor = DTYPE_f(1) if norm == 'forward' else DTYPE_f(0.5)
 
     ifft_output_d = gpuarray.empty((m, n), dtype=DTYPE_f)
-    w_d = gpuarray.to_gpu(np.exp(DTYPE_c(1j * np.pi) * np.arange(freq_width, dtype=DTYPE_f) / DTYPE_f(2 * n))
-                          * normal_factor)
+    w_d = _get_idct_weights(n, norm)
 
-    fft_data_flip = _flip_frequency_real(y_d, freq_width, left_pad=1)
-    ifft_input_d = cumisc.multiply(y_d[:, :freq_width].copy() - DTYPE_c(1j) * fft_data_flip, w_d)
+    ifft_input_d = gpuarray.empty((m, freq_width), dtype=DTYPE_c)
+    _idct_input(ifft_input_d, y_d, w_d, n, freq_width)
 
-    plan_inverse = cufft.Plan((n,), DTYPE_c, DTYPE_f, batch=m)
+    plan_inverse = _get_fft_plan(n, DTYPE_c, DTYPE_f, m)
     cufft.ifft(ifft_input_d, ifft_output_d, plan_inverse, scale=scale)
     yidct_d = _dct_order(ifft_output_d, 'backward')
 
@@ -479,6 +545,74 @@ def gpu_idct(y_d, norm='backward'):
     return yidct_d
 
 
+def _check_smooth_order_spacing(smooth_order, spacing, ndim):
+    """Raises a ValueError if the order criterion or the spacing are invalid for fields of the given dimension."""
+    if smooth_order not in {0, 1, 2}:
+        raise ValueError('smooth_order must be 0, 1 or 2.')
+    if spacing is not None:
+        spacing = np.array(spacing)
+        if spacing.size != ndim:
+            raise ValueError('spacing must be either None or an array-like with size == y.ndim')
+        if np.any(spacing < 0):
+            raise ValueError('spacing must all be greater than zero.')
+
+
+def _is_direct_smoothing(y_dl, s=None, mask=None, w=None, robust=False, **kwargs):
+    """Returns whether 2D fields can be smoothed in one pass on the GPU, which is when smoothn would not iterate."""
+    if s is None or not 0 < s == float(s) or mask is not None or w is not None or robust:
+        return False
+    if y_dl[0].ndim != 2 or min(y_dl[0].shape) < 2 or any(y_d.shape != y_dl[0].shape for y_d in y_dl):
+        return False
+
+    # Non-finite values are treated as missing data, which requires the weighted, iterative process.
+    return all(np.isfinite(gpuarray.sum(y_d).get()) for y_d in y_dl)
+
+
+def _gpu_smooth_direct(y_dl, s, smooth_order=2, spacing=None, out_dl=None):
+    """Returns the 2D fields smoothed on the GPU with a fixed smoothing parameter and uniform weights.
+
+    If out_dl is given, the smoothed fields are written into its arrays.
+
+    """
+    y_shape = y_dl[0].shape
+    if spacing is not None:
+        spacing = np.array(spacing) / np.amax(spacing)
+    else:
+        spacing = np.ones(len(y_shape))
+
+    # Gamma coefficients of the DCT-domain filter.
+    lambda_ = _lambda(np.empty(y_shape, dtype=DTYPE_f), spacing) ** smooth_order
+    gamma_d = gpuarray.to_gpu((1 / (1 + s * lambda_)).astype(DTYPE_f))
+
+    if out_dl is None:
+        out_dl = [None] * len(y_dl)
+
+    return [_gpu_dct_2d(gamma_d * _gpu_dct_2d(y_d, gpu_dct), gpu_idct, out_d=out_d) for y_d, out_d in zip(y_dl, out_dl)]
+
+
+def _gpu_dct_2d(y_d, f=gpu_dct, out_d=None):
+    """Returns the orthogonal, 2D transform of the input, applying f to the rows and then to the columns.
+
+    If out_d is given, the transform is written into it.
+
+    """
+    m, n = y_d.shape
+
+    y_rows_d = f(y_d, norm='ortho')
+    y_transpose_d = gpuarray.empty((n, m), dtype=DTYPE_f)
+    _transpose(y_transpose_d, y_rows_d, DTYPE_i(m), DTYPE_i(n))
+    y_cols_d = f(y_transpose_d, norm='ortho')
+    y_dct_d = out_d if out_d is not None else gpuarray.empty((m, n), dtype=DTYPE_f)
+    _transpose(y_dct_d, y_cols_d, DTYPE_i(n), DTYPE_i(m))
+
+    return y_dct_d
+
+
+# Transposes an (ht, wd) array into a (wd, ht) array.
+_transpose = ElementwiseKernel('float *dest, float *src, int ht, int wd', 'dest[i] = src[(i % ht) * wd + i / ht]',
+                               'transpose')
+
+
 def replace_non_finite(y, finite=None, spacing=None):
     """Returns array with non-finite values replaced using nearest-neighbour interpolation.
 
@@ -709,6 +843,8 @@ __global__ void backward_order(float *dest, float *src, int wd, int size)
     dest[row * wd + col] = src[row * wd + (col % 2 == 0) * (col / 2) + (col % 2 == 1) * (wd - 1 - col / 2)];
 }
 """)
+_order = {direction: mod_order.get_function(direction + '_order').prepare('PPii')
+          for direction in ('forward', 'backward')}
 
 
 def _dct_order(y_d, direction):
@@ -723,13 +859,9 @@ def _dct_order(y_d, direction):
 
     y_ordered = gpuarray.empty((m, n), dtype=DTYPE_f)
 
-    block_size = 32
+    block_size = _BLOCK_SIZE
     x_blocks = ceil(size / block_size)
-    if direction == 'forward':
-        order = mod_order.get_function('forward_order')
-    else:
-        order = mod_order.get_function('backward_order')
-    order(y_ordered, y_d, DTYPE_i(n), DTYPE_i(size), block=(block_size, 1, 1), grid=(x_blocks, 1))
+    _order[direction].prepared_call((x_blocks, 1), (block_size, 1, 1), y_ordered.gpudata, y_d.gpudata, n, size)
 
     return y_ordered
 
@@ -746,6 +878,7 @@ __global__ void flip_frequency(float *dest, float *src, int offset, int left_pad
     dest[row * y_width + col + left_pad] = src[row * wd + wd - col - 1 - offset];
 }
 """)
+_flip_frequency = mod_flip.get_function('flip_frequency').prepare('PPiiiii')
 
 
 def _flip_frequency_real(y_d, flip_width, offset=0, left_pad=0):
@@ -757,11 +890,10 @@ def _flip_frequency_real(y_d, flip_width, offset=0, left_pad=0):
 
     y_flipped_d = gpuarray.zeros((m, flip_width), dtype=DTYPE_f)
 
-    block_size = 32
+    block_size = _BLOCK_SIZE
     x_blocks = ceil(size / block_size)
-    flip_frequency = mod_flip.get_function('flip_frequency')
-    flip_frequency(y_flipped_d, y_d, DTYPE_i(offset), DTYPE_i(left_pad), DTYPE_i(flip_width), DTYPE_i(n), DTYPE_i(size),
-                   block=(block_size, 1, 1), grid=(x_blocks, 1))
+    _flip_frequency.prepared_call((x_blocks, 1), (block_size, 1, 1), y_flipped_d.gpudata, y_d.gpudata, offset, left_pad,
+                                  flip_width, n, size)
 
     return y_flipped_d
 
@@ -9,7 +9,7 @@ import pycuda.gpuarray as gpuarray
 # import pycuda.cumath as cumath
 from pycuda.compiler import SourceModule
 
-from openpiv.gpu_misc import _check_arrays, gpu_mask
+from openpiv.gpu_misc import _check_arrays, _is_aligned, gpu_mask
 
 # Define 32-bit types
 DTYPE_i = np.int32
@@ -21,7 +21,8 @@ S2N_TOL = 2
 MEDIAN_TOL = 2
 MEAN_TOL = 2
 RMS_TOL = 2
-_BLOCK_SIZE = 64
+_BLOCK_SIZE = 256
+_NEIGHBOUR_CELLS = 4
 
 
 def gpu_validation(*f_d, sig2noise_d=None, mask_d=None, validation_method='median_velocity',
@@ -95,9 +96,12 @@ class ValidationGPU:
 
         self._val_locations_d = None
         self._f_d = None
+        self._f_stack_d = None
         self._f_neighbours_d = None
         self._f_median_d = None
         self._f_mean_d = None
+        self._f_mean_fluc_d = None
+        self._f_rms_d = None
 
         self._check_validation_methods()
         self._check_validation_tolerances()
@@ -144,9 +148,12 @@ class ValidationGPU:
     def free_data(self):
         self._val_locations_d = None
         self._f_d = None
+        self._f_stack_d = None
         self._f_neighbours_d = None
         self._f_median_d = None
         self._f_mean_d = None
+        self._f_mean_fluc_d = None
+        self._f_rms_d = None
 
     @property
     def median_d(self):
@@ -170,73 +177,76 @@ class ValidationGPU:
         _check_arrays(sig2noise_d, array_type=gpuarray.GPUArray, dtype=DTYPE_f, size=prod(self.f_shape))
         s2n_tol = log10(self.validation_tols['s2n'])
 
-        sig2noise_tol_d = sig2noise_d / DTYPE_f(s2n_tol)
-        self._val_locations_d = _local_validation(sig2noise_tol_d, 1, self._val_locations_d)
+        self._val_locations_d = _local_validation(sig2noise_d, 1, self._val_locations_d, scale=s2n_tol)
 
     def _median_validation(self):
-        """Performs median validation on each field."""
-        f_neighbours_d = self._get_neighbours()
-        f_median_d = self._get_median()
+        """Performs median validation on all fields at once."""
+        self._get_median()
         median_tol = self.validation_tols['median']
 
-        for k in range(self._num_fields):
-            f_median_fluc_d = _gpu_median_fluc(f_median_d[k], f_neighbours_d[k], self._neighbours_present_d)
-            self._val_locations_d = _neighbour_validation(self._f_d[k], f_median_d[k], f_median_fluc_d,
-                                                          median_tol, self._val_locations_d)
+        f_median_fluc_d = _gpu_median_fluc(self._f_median_d, self._f_neighbours_d, self._neighbours_present_d)
+        self._val_locations_d = _neighbour_validation(self._get_f_stack(), self._f_median_d, f_median_fluc_d,
+                                                      median_tol, self._val_locations_d)
 
     def _mean_validation(self):
-        """Performs mean validation on each field."""
-        f_neighbours_d = self._get_neighbours()
-        f_mean_d = self._get_mean()
+        """Performs mean validation on all fields at once."""
+        self._get_mean_stats()
         mean_tol = self.validation_tols['mean']
 
-        for k in range(self._num_fields):
-            f_mean_fluc_d = _gpu_mean_fluc(f_mean_d[k], f_neighbours_d[k], self._neighbours_present_d)
-            self._val_locations_d = _neighbour_validation(self._f_d[k], f_mean_d[k], f_mean_fluc_d, mean_tol,
-                                                          self._val_locations_d)
+        self._val_locations_d = _neighbour_validation(self._get_f_stack(), self._f_mean_d, self._f_mean_fluc_d,
+                                                      mean_tol, self._val_locations_d)
 
     def _rms_validation(self):
-        """Performs RMS validation on each field."""
-        f_neighbours_d = self._get_neighbours()
-        f_mean_d = self._get_mean()
+        """Performs RMS validation on all fields at once."""
+        self._get_mean_stats()
         rms_tol = self.validation_tols['rms']
 
-        for k in range(self._num_fields):
-            f_rms_d = _gpu_rms(f_mean_d[k], f_neighbours_d[k], self._neighbours_present_d)
-            self._val_locations_d = _neighbour_validation(self._f_d[k], f_mean_d[k], f_rms_d, rms_tol,
-                                                          self._val_locations_d)
+        self._val_locations_d = _neighbour_validation(self._get_f_stack(), self._f_mean_d, self._f_rms_d, rms_tol,
+                                                      self._val_locations_d)
 
     def _mask_val_locations(self):
         """Removes masked locations from the validation locations."""
         if self.mask_d is not None and self._val_locations_d is not None:
             self._val_locations_d = gpu_mask(self._val_locations_d, self.mask_d)
 
+    def _get_f_stack(self):
+        """Returns the fields stacked into one (num_fields, m, n) array, so that each kernel processes all of them."""
+        if self._f_stack_d is None:
+            if self._num_fields == 1:
+                self._f_stack_d = self._f_d[0].reshape(1, *self.f_shape)
+            else:
+                self._f_stack_d = gpuarray.empty((self._num_fields, *self.f_shape), dtype=DTYPE_f)
+                for k in range(self._num_fields):
+                    self._f_stack_d[k] = self._f_d[k]
+
+        return self._f_stack_d
+
     def _get_neighbours(self):
         """Returns neighbouring values for each field."""
         if self._f_neighbours_d is None:
-            self._f_neighbours_d = [_gpu_get_neighbours(f_d, self._neighbours_present_d) for f_d in self._f_d]
+            self._f_neighbours_d = _gpu_get_neighbours(self._get_f_stack(), self._neighbours_present_d)
 
-        return self._f_neighbours_d
+        return _unstack(self._f_neighbours_d)
 
     def _get_median(self):
         """Returns field containing median of surrounding points for each field."""
-        f_neighbours_d = self._get_neighbours()
-
         if self._f_median_d is None:
-            self._f_median_d = [_gpu_median_velocity(f_neighbours_d[k], self._neighbours_present_d)
-                                for k in range(self._num_fields)]
+            self._get_neighbours()
+            self._f_median_d = _gpu_median_velocity(self._f_neighbours_d, self._neighbours_present_d)
 
-        return self._f_median_d
+        return _unstack(self._f_median_d)
 
     def _get_mean(self):
         """Returns field containing mean of surrounding points for each field."""
-        f_neighbours_d = self._get_neighbours()
+        return self._get_mean_stats()[0]
 
+    def _get_mean_stats(self):
+        """Returns the mean, mean fluctuation and RMS of surrounding points for each field."""
         if self._f_mean_d is None:
-            self._f_mean_d = [_gpu_mean_velocity(f_neighbours_d[k], self._neighbours_present_d)
-                              for k in range(self._num_fields)]
+            self._f_mean_d, self._f_mean_fluc_d, self._f_rms_d = _gpu_mean_stats(self._get_f_stack(),
+                                                                                 self._neighbours_present_d)
 
-        return self._f_mean_d
+        return _unstack(self._f_mean_d), _unstack(self._f_mean_fluc_d), _unstack(self._f_rms_d)
 
     def _check_validation_methods(self):
         """Checks that input validation methods are allowed."""
@@ -250,28 +260,43 @@ class ValidationGPU:
             raise ValueError('Invalid validation tolerances(s). Validation tolerances must be greater than 0.')
 
 
+def _unstack(f_d):
+    """Returns a list of views of the fields stacked along the first axis."""
+    return [f_d[k] for k in range(f_d.shape[0])]
+
+
 mod_validation = SourceModule("""
-__global__ void local_validation(int *val_locations, float *f, float tol, int size)
+__global__ void local_validation(int *val_locations, float *f, float tol, float scale, int size)
 {
+    // scale : divides the values before they are compared with the tolerance
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
-    val_locations[t_idx] = val_locations[t_idx] || (f[t_idx] > tol);
+    val_locations[t_idx] = val_locations[t_idx] || (f[t_idx] / scale > tol);
 }
 
-__global__ void neighbour_validation(int *val_locations, float *f, float *f_mean, float *f_fluc, float tol, int size)
+__global__ void neighbour_validation(int *val_locations, float *f, float *f_mean, float *f_fluc, float tol,
+                                     int num_fields, int size)
 {
+    // f, f_mean, f_fluc : num_fields stacked fields of the given size
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
 
     // a small number is added to prevent singularities in uniform flow (Scarano & Westerweel, 2005)
-    val_locations[t_idx] = val_locations[t_idx] || (fabsf(f[t_idx] - f_mean[t_idx]) / (f_fluc[t_idx] + 0.1f) > tol);
+    int val_location = val_locations[t_idx];
+    for (int k = 0; k < num_fields; k++) {
+        int idx = k * size + t_idx;
+        val_location = val_location || (fabsf(f[idx] - f_mean[idx]) / (f_fluc[idx] + 0.1f) > tol);
+    }
+    val_locations[t_idx] = val_location;
 }
 """)
+_local_validation_f = mod_validation.get_function('local_validation').prepare('PPffi')
+_neighbour_validation_f = mod_validation.get_function('neighbour_validation').prepare('PPPPfii')
 
 
-def _local_validation(f_d, tol, val_locations_d=None):
-    """Updates the validation list by checking if the array elements exceed the tolerance."""
+def _local_validation(f_d, tol, val_locations_d=None, scale=1):
+    """Updates the validation list by checking if the array elements, divided by scale, exceed the tolerance."""
     size = f_d.size
 
     if val_locations_d is None:
@@ -279,60 +304,115 @@ def _local_validation(f_d, tol, val_locations_d=None):
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    local_validation = mod_validation.get_function('local_validation')
-    local_validation(val_locations_d, f_d, DTYPE_f(tol), DTYPE_i(size), block=(block_size, 1, 1), grid=(grid_size, 1))
+    _local_validation_f.prepared_call((grid_size, 1), (block_size, 1, 1), val_locations_d.gpudata, f_d.gpudata, tol,
+                                      scale, size)
 
     return val_locations_d
 
 
 def _neighbour_validation(f_d, f_mean_d, f_mean_fluc_d, tol, val_locations_d=None):
-    """Updates the validation list by checking if the neighbouring elements exceed the tolerance."""
-    size = f_d.size
+    """Updates the validation list by checking if the neighbouring elements exceed the tolerance.
+
+    The inputs can be stacked fields of shape (num_fields, m, n), which are all validated in the same launch.
+
+    """
+    m, n = f_d.shape[-2:]
+    size = m * n
+    num_fields = f_d.size // size
 
     if val_locations_d is None:
-        val_locations_d = gpuarray.zeros_like(f_d, dtype=DTYPE_i)
+        val_locations_d = gpuarray.zeros((m, n), dtype=DTYPE_i)
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    neighbour_validation = mod_validation.get_function('neighbour_validation')
-    neighbour_validation(val_locations_d, f_d, f_mean_d, f_mean_fluc_d, DTYPE_f(tol), DTYPE_i(size),
-                         block=(block_size, 1, 1), grid=(grid_size, 1))
+    _neighbour_validation_f.prepared_call((grid_size, 1), (block_size, 1, 1), val_locations_d.gpudata, f_d.gpudata,
+                                          f_mean_d.gpudata, f_mean_fluc_d.gpudata, tol, num_fields, size)
 
     return val_locations_d
 
 
-mod_neighbours = SourceModule("""
-__global__ void find_neighbours(int *np, int *mask, int n, int m, int size)
+# Device functions that read or write the eight neighbours of a point in an (m, n, 8) array with two 16-byte accesses.
+_NEIGHBOUR_ACCESS = """
+__device__ void load_neighbours(float *A, const float *nb, int t_idx)
 {
-    // np : neighbours_present
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
-    if (t_idx >= size) {return;}
+    float4 a = reinterpret_cast<const float4 *>(nb)[2 * t_idx];
+    float4 b = reinterpret_cast<const float4 *>(nb)[2 * t_idx + 1];
+    A[0] = a.x; A[1] = a.y; A[2] = a.z; A[3] = a.w;
+    A[4] = b.x; A[5] = b.y; A[6] = b.z; A[7] = b.w;
+}
 
-    int nb_idx = t_idx % 8;
-    int row_idx = t_idx / 8 / n - (nb_idx < 3) + (nb_idx > 4); 
-    int col_idx = t_idx / 8 % n - ((nb_idx == 0) || (nb_idx == 3) || (nb_idx == 5))
-                                + ((nb_idx == 2) || (nb_idx == 4) || (nb_idx == 7));
-    int in_bound = (row_idx >= 0) * (row_idx < m) * (col_idx >= 0) * (col_idx < n);
+__device__ void store_neighbours(float *nb, const float *A, int t_idx)
+{
+    reinterpret_cast<float4 *>(nb)[2 * t_idx] = make_float4(A[0], A[1], A[2], A[3]);
+    reinterpret_cast<float4 *>(nb)[2 * t_idx + 1] = make_float4(A[4], A[5], A[6], A[7]);
+}
+"""
 
-    np[t_idx] = in_bound * (!mask[(row_idx * n + col_idx) * in_bound]);
+mod_neighbours = SourceModule(_NEIGHBOUR_ACCESS + """
+__global__ void find_neighbours(unsigned char *np, const int * __restrict__ mask, int n, int m)
+{
+    // np : neighbours_present, bit i is set if neighbour i is present
+    int col = blockIdx.x * blockDim.x + threadIdx.x;
+    int row = blockIdx.y * blockDim.y + threadIdx.y;
+    if (col >= n || row >= m) {return;}
+    int t_idx = row * n + col;
+
+    // Each thread handles all neighbours of one point, so that adjacent threads read adjacent points of the mask.
+    // Every point of the mask is read by up to 8 threads, so the loads go through the read-only cache.
+    unsigned char np_bits = 0;
+    #pragma unroll
+    for (int nb_idx = 0; nb_idx < 8; nb_idx++) {
+        int row_idx = row - (nb_idx < 3) + (nb_idx > 4);
+        int col_idx = col - ((nb_idx == 0) || (nb_idx == 3) || (nb_idx == 5))
+                          + ((nb_idx == 2) || (nb_idx == 4) || (nb_idx == 7));
+        int in_bound = (row_idx >= 0) && (row_idx < m) && (col_idx >= 0) && (col_idx < n);
+        np_bits |= (in_bound && !__ldg(&mask[row_idx * n + col_idx])) << nb_idx;
+    }
+    np[t_idx] = np_bits;
 }
 
-__global__ void get_neighbours(float *nb, int *np, float *f, int n, int size)
+__global__ void get_neighbours(float *nb, unsigned char *np, float *f, int n, int m)
 {
     // nb : values of the neighbouring points
-    // np : 1 if there is a neighbour, 0 if no neighbour
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
-    if (t_idx >= size) {return;}
-    
-    int nb_idx = t_idx % 8;
-    int row_idx = t_idx / 8 / n - (nb_idx < 3) + (nb_idx > 4); 
-    int col_idx = t_idx / 8 % n - ((nb_idx == 0) || (nb_idx == 3) || (nb_idx == 5))
-                                + ((nb_idx == 2) || (nb_idx == 4) || (nb_idx == 7));
+    // np : bit i is set if neighbour i is present
+    // Each thread handles NEIGHBOUR_CELLS consecutive points of a row, which share most of their neighbours.
+    int col_0 = (blockIdx.x * blockDim.x + threadIdx.x) * NEIGHBOUR_CELLS;
+    int row = blockIdx.y * blockDim.y + threadIdx.y;
+    if (col_0 >= n || row >= m) {return;}
+
+    // The fields are stacked along blockIdx.z and share the neighbour bitmask.
+    f += blockIdx.z * m * n;
+    nb += blockIdx.z * m * n * 8;
+
+    // Load the 3 rows around the points once, from the column before the first point to the one after the last.
+    float w[3][NEIGHBOUR_CELLS + 2];
+    #pragma unroll
+    for (int i = 0; i < 3; i++) {
+        int row_idx = row + i - 1;
+        #pragma unroll
+        for (int j = 0; j < NEIGHBOUR_CELLS + 2; j++) {
+            int col_idx = col_0 + j - 1;
+            int in_bound = (row_idx >= 0) && (row_idx < m) && (col_idx >= 0) && (col_idx < n);
+            w[i][j] = in_bound ? f[row_idx * n + col_idx] : 0.0f;
+        }
+    }
 
     // get neighbouring values
-    nb[t_idx] = f[(row_idx * n + col_idx) * np[t_idx]] * np[t_idx];
+    #pragma unroll
+    for (int c = 0; c < NEIGHBOUR_CELLS; c++) {
+        if (col_0 + c >= n) {return;}
+        int t_idx = row * n + col_0 + c;
+        unsigned char np_bits = np[t_idx];
+
+        float A[8] = {w[0][c], w[0][c + 1], w[0][c + 2], w[1][c], w[1][c + 2], w[2][c], w[2][c + 1], w[2][c + 2]};
+        #pragma unroll
+        for (int nb_idx = 0; nb_idx < 8; nb_idx++) {A[nb_idx] = (np_bits >> nb_idx) & 1 ? A[nb_idx] : 0.0f;}
+        store_neighbours(nb, A, t_idx);
+    }
 }
-""")
+""", options=['-DNEIGHBOUR_CELLS={}'.format(_NEIGHBOUR_CELLS)])
+_find_neighbours = mod_neighbours.get_function('find_neighbours').prepare('PPii')
+_get_neighbours = mod_neighbours.get_function('get_neighbours').prepare('PPPii')
 
 
 def _gpu_find_neighbours(shape, mask_d=None):
@@ -348,21 +428,21 @@ def _gpu_find_neighbours(shape, mask_d=None):
     Returns
     -------
     GPUArray
-        4D (m, n, 8), value of one where the point in the field has neighbours.
+        2D uint8 (m, n), bit i is set where the point in the field has neighbour i.
 
     """
     m, n = shape
-    size = m * n * 8
     if mask_d is None:
         mask_d = gpuarray.zeros((m, n), dtype=DTYPE_i)
 
-    neighbours_present_d = gpuarray.empty((m, n, 8), dtype=DTYPE_i)
+    neighbours_present_d = gpuarray.empty((m, n), dtype=np.uint8)
 
-    block_size = _BLOCK_SIZE
-    grid_size = ceil(size / block_size)
-    find_neighbours = mod_neighbours.get_function('find_neighbours')
-    find_neighbours(neighbours_present_d, mask_d, DTYPE_i(n), DTYPE_i(m), DTYPE_i(size), block=(block_size, 1, 1),
-                    grid=(grid_size, 1))
+    block_size_x = min(32, n)
+    block_size_y = _BLOCK_SIZE // block_size_x
+    grid_size_x = ceil(n / block_size_x)
+    grid_size_y = ceil(m / block_size_y)
+    _find_neighbours.prepared_call((grid_size_x, grid_size_y), (block_size_x, block_size_y, 1),
+                                   neighbours_present_d.gpudata, mask_d.gpudata, n, m)
 
     return neighbours_present_d
 
@@ -373,138 +453,134 @@ def _gpu_get_neighbours(f_d, neighbours_present_d):
     Parameters
     ----------
     f_d : GPUArray
-        2D float (m, n), values from which to get neighbours.
+        2D float (m, n) or 3D float (num_fields, m, n), values from which to get neighbours.
     neighbours_present_d : GPUArray
-        4D int (m, n, 8), value of one where a neighbour is present.
+        2D uint8 (m, n), bit i is set where neighbour i is present.
 
     Returns
     -------
     GPUArray
-        4D float (m, n, 8), values of u and v of the neighbours of a point.
+        float (..., m, n, 8), values of u and v of the neighbours of a point.
 
     """
-    m, n = f_d.shape
-    size = f_d.size * 8
+    m, n = f_d.shape[-2:]
+    num_fields = f_d.size // (m * n)
 
-    neighbours_d = gpuarray.empty((m, n, 8), dtype=DTYPE_f)
+    neighbours_d = gpuarray.empty((*f_d.shape, 8), dtype=DTYPE_f)
 
-    block_size = _BLOCK_SIZE
-    grid_size = ceil(size / block_size)
-    get_neighbours = mod_neighbours.get_function('get_neighbours')
-    get_neighbours(neighbours_d, neighbours_present_d, f_d, DTYPE_i(n), DTYPE_i(size), block=(block_size, 1, 1),
-                   grid=(grid_size, 1))
+    # Each thread gets the neighbours of _NEIGHBOUR_CELLS points along a row.
+    block_size_x = min(32, ceil(n / _NEIGHBOUR_CELLS))
+    block_size_y = _BLOCK_SIZE // block_size_x
+    grid_size_x = ceil(n / (block_size_x * _NEIGHBOUR_CELLS))
+    grid_size_y = ceil(m / block_size_y)
+    _get_neighbours.prepared_call((grid_size_x, grid_size_y, num_fields), (block_size_x, block_size_y, 1),
+                                  neighbours_d.gpudata, neighbours_present_d.gpudata, f_d.gpudata, n, m)
 
     return neighbours_d
 
 
-mod_median_velocity = SourceModule("""
-// device-side function to swap elements of two arrays.
-__device__ void swap(float *A, int a, int b)
-{
-    float tmp_A = A[a];
-    A[a] = A[b];
-    A[b] = tmp_A;
-}
+# The source has no #include, so PyCUDA can find its cached binary without running the preprocessor first.
+mod_median_velocity = SourceModule(_NEIGHBOUR_ACCESS + """
+// Positive infinity, used to sort missing neighbours to the end.
+#define INF __int_as_float(0x7f800000)
 
-// device-side function to compare and swap elements of two arrays.
-__device__ void compare(float *A, float *B, int a, int b)
+// device-side function to compare and swap two values, leaving the smaller one in a.
+__device__ void compare(float &a, float &b)
 {
-    // Move non-neighbour values to end.
-    if (B[a] < B[b])
-    {
-        swap(A, a, b);
-        swap(B, a, b);
-    }
-    // Move greater values to right.
-    else if (A[a] > A[b] && B[a] == B[b] == 1)
-    {
-        swap(A, a, b);
-        swap(B, a, b);
-    }
+    float tmp = fminf(a, b);
+    b = fmaxf(a, b);
+    a = tmp;
 }
 
 // device-side function to do an 8-wire sorting network.
-__device__ void sort(float *A, float *B)
+__device__ void sort(float *A)
 {
-    compare(A, B, 0, 1);
-    compare(A, B, 2, 3);
-    compare(A, B, 4, 5);
-    compare(A, B, 6, 7);
-    compare(A, B, 0, 2);
-    compare(A, B, 1, 3);
-    compare(A, B, 4, 6);
-    compare(A, B, 5, 7);
-    compare(A, B, 1, 2);
-    compare(A, B, 5, 6);
-    compare(A, B, 0, 4);
-    compare(A, B, 3, 7);
-    compare(A, B, 1, 5);
-    compare(A, B, 2, 6);
-    compare(A, B, 1, 4);
-    compare(A, B, 3, 6);
-    compare(A, B, 2, 4);
-    compare(A, B, 3, 5);
-    compare(A, B, 3, 4);
+    compare(A[0], A[1]);
+    compare(A[2], A[3]);
+    compare(A[4], A[5]);
+    compare(A[6], A[7]);
+    compare(A[0], A[2]);
+    compare(A[1], A[3]);
+    compare(A[4], A[6]);
+    compare(A[5], A[7]);
+    compare(A[1], A[2]);
+    compare(A[5], A[6]);
+    compare(A[0], A[4]);
+    compare(A[3], A[7]);
+    compare(A[1], A[5]);
+    compare(A[2], A[6]);
+    compare(A[1], A[4]);
+    compare(A[3], A[6]);
+    compare(A[2], A[4]);
+    compare(A[3], A[5]);
+    compare(A[3], A[4]);
 }
 
-__device__ float median(float *A, float *B)
+__device__ float median(float *A, int N)
 {
-    // Count the neighbouring points.
-    int N = B[0] + B[1] + B[2] + B[3] + B[4] + B[5] + B[6] + B[7];
+    // Select the middle values with constant indices so that A can stay in registers.
+    float f_low = 0.0f;
+    float f_high = 0.0f;
+    #pragma unroll
+    for (int i = 0; i < 8; i++) {
+        f_low = i == (N - 1) / 2 ? A[i] : f_low;
+        f_high = i == N / 2 ? A[i] : f_high;
+    }
 
     // Return the median out of N neighbours.
-    if (N % 2 == 0) {return (A[N / 2 - 1] + A[N / 2]) / 2;}
-    else {return A[N / 2];}
+    return N > 0 ? (f_low + f_high) / 2 : 0.0f;
 }
 
-__global__ void median_velocity(float *f_median, float *nb, int *np, int size)
+__global__ void median_velocity(float *f_median, float *nb, unsigned char *np, int size)
 {
     // nb : values of the neighbouring points.
-    // np : 1 if there is a neighbour, 0 if no neighbour.
+    // np : bit i is set if neighbour i is present.
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
+    unsigned char np_bits = np[t_idx];
 
-    // Loop through neighbours to populate an array to sort.
-    int i;
-    int j = 0;
+    // The fields are stacked along blockIdx.y and share the neighbour bitmask.
+    t_idx += blockIdx.y * size;
+
+    // Missing neighbours are sorted to the end.
     float A[8];
-    float B[8];
-    for (i = 0; i < 8; i++) {
-        A[j] = nb[t_idx * 8 + i];
-        B[j++] = np[t_idx * 8 + i];
-    }
+    load_neighbours(A, nb, t_idx);
+    #pragma unroll
+    for (int i = 0; i < 8; i++) {A[i] = (np_bits >> i) & 1 ? A[i] : INF;}
 
-    // Sort the arrays.
-    sort(A, B);
+    // Sort the array.
+    sort(A);
 
-    f_median[t_idx] = median(A, B);
+    f_median[t_idx] = median(A, __popc(np_bits));
 }
 
-__global__ void median_fluc(float *f_median_fluc, float *f_median, float *nb, int *np, int size)
+__global__ void median_fluc(float *f_median_fluc, float *f_median, float *nb, unsigned char *np, int size)
 {
     // nb : value of the neighbouring points
-    // np : 1 if there is a neighbour, 0 if no neighbour
+    // np : bit i is set if neighbour i is present
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
+    unsigned char np_bits = np[t_idx];
+
+    // The fields are stacked along blockIdx.y and share the neighbour bitmask.
+    t_idx += blockIdx.y * size;
 
     float f_m = f_median[t_idx];
 
-    // Loop through neighbours to populate an array to sort.
-    int i;
-    int j = 0;
+    // Missing neighbours are sorted to the end.
     float A[8];
-    float B[8];
-    for (i = 0; i < 8; i++) {
-        A[j] = fabsf(nb[t_idx * 8 + i] - f_m);
-        B[j++] = np[t_idx * 8 + i];
-    }
+    load_neighbours(A, nb, t_idx);
+    #pragma unroll
+    for (int i = 0; i < 8; i++) {A[i] = (np_bits >> i) & 1 ? fabsf(A[i] - f_m) : INF;}
 
-    // Sort the arrays.
-    sort(A, B);
+    // Sort the array.
+    sort(A);
 
-    f_median_fluc[t_idx] = median(A, B);
+    f_median_fluc[t_idx] = median(A, __popc(np_bits));
 }
 """)
+_median_velocity = mod_median_velocity.get_function('median_velocity').prepare('PPPi')
+_median_fluc = mod_median_velocity.get_function('median_fluc').prepare('PPPPi')
 
 
 def _gpu_median_velocity(f_neighbours_d, neighbours_present_d):
@@ -513,26 +589,27 @@ def _gpu_median_velocity(f_neighbours_d, neighbours_present_d):
     Parameters
     ----------
     f_neighbours_d: GPUArray
-        4D float (m, n, 8), neighbouring velocities of every point.
+        float (..., m, n, 8), neighbouring velocities of every point of one or more stacked fields.
     neighbours_present_d: GPUArray
-        4D int (m, n, 8), value of one where a neighbour is present.
+        2D uint8 (m, n), bit i is set where neighbour i is present.
 
     Returns
     -------
     GPUArray
-        2D float (m, n), mean velocities at each point.
+        float (..., m, n), mean velocities at each point.
 
     """
-    m, n, _ = f_neighbours_d.shape
+    assert _is_aligned(f_neighbours_d), 'The neighbours must be 16-byte aligned for vector loads.'
+    m, n, _ = f_neighbours_d.shape[-3:]
     size = m * n
+    num_fields = f_neighbours_d.size // (size * 8)
 
-    f_median_d = gpuarray.empty((m, n), dtype=DTYPE_f)
+    f_median_d = gpuarray.empty(f_neighbours_d.shape[:-1], dtype=DTYPE_f)
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    median_velocity = mod_median_velocity.get_function('median_velocity')
-    median_velocity(f_median_d, f_neighbours_d, neighbours_present_d, DTYPE_i(size), block=(block_size, 1, 1),
-                    grid=(grid_size, 1))
+    _median_velocity.prepared_call((grid_size, num_fields), (block_size, 1, 1), f_median_d.gpudata,
+                                   f_neighbours_d.gpudata, neighbours_present_d.gpudata, size)
 
     return f_median_d
 
@@ -543,192 +620,117 @@ def _gpu_median_fluc(f_median_d, f_neighbours_d, neighbours_present_d):
     Parameters
     ----------
     f_median_d : GPUArray
-        2D float (m, n), mean velocities around each point.
+        float (..., m, n), mean velocities around each point of one or more stacked fields.
     f_neighbours_d : GPUArray
-        4D float (m, n, 8), neighbouring velocities of every point.
+        float (..., m, n, 8), neighbouring velocities of every point.
     neighbours_present_d : GPUArray
-        4D int  (m, n, 8), value of one where a neighbour is present.
+        2D uint8 (m, n), bit i is set where neighbour i is present.
 
     Returns
     -------
     GPUArray
-        2D float (m, n), RMS velocities at each point.
+        float (..., m, n), RMS velocities at each point.
 
     """
-    m, n = f_median_d.shape
-    size = f_median_d.size
+    assert _is_aligned(f_neighbours_d), 'The neighbours must be 16-byte aligned for vector loads.'
+    m, n = f_median_d.shape[-2:]
+    size = m * n
+    num_fields = f_median_d.size // size
 
-    f_median_fluc_d = gpuarray.empty((m, n), dtype=DTYPE_f)
+    f_median_fluc_d = gpuarray.empty(f_median_d.shape, dtype=DTYPE_f)
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    median_u_fluc = mod_median_velocity.get_function('median_fluc')
-    median_u_fluc(f_median_fluc_d, f_median_d, f_neighbours_d, neighbours_present_d, DTYPE_i(size),
-                  block=(block_size, 1, 1), grid=(grid_size, 1))
+    _median_fluc.prepared_call((grid_size, num_fields), (block_size, 1, 1), f_median_fluc_d.gpudata,
+                               f_median_d.gpudata, f_neighbours_d.gpudata, neighbours_present_d.gpudata, size)
 
     return f_median_fluc_d
 
 
 mod_mean_velocity = SourceModule("""
-__device__ float num_neighbours(int *np, int t_idx)
+// Returns the number of neighbours in a bitmask, or 1 if there are none.
+__device__ float num_neighbours(unsigned char np_bits)
 {
-    float denominator = np[t_idx * 8 + 0] + np[t_idx * 8 + 1] + np[t_idx * 8 + 2] + np[t_idx * 8 + 3]
-                        + np[t_idx * 8 + 4] + np[t_idx * 8 + 5] + np[t_idx * 8 + 6] + np[t_idx * 8 + 7];
+    float denominator = __popc(np_bits);
     return denominator + (denominator == 0.0f);
 }
 
 
-__global__ void mean_velocity(float *f_mean, float *nb, int *np, int size)
-{
-    // n : value of neighbours.
-    // np : neighbours present.
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
-    if (t_idx >= size) {return;}
-
-    // Sum terms of the mean.
-    float numerator = nb[t_idx * 8 + 0] + nb[t_idx * 8 + 1] + nb[t_idx * 8 + 2] + nb[t_idx * 8 + 3]
-                        + nb[t_idx * 8 + 4] + nb[t_idx * 8 + 5] + nb[t_idx * 8 + 6] + nb[t_idx * 8 + 7];
-
-    // Mean is normalized by number of terms summed.
-    float denominator = num_neighbours(np, t_idx);
-    f_mean[t_idx] = numerator / denominator;
-}
-
-__global__ void mean_fluc(float *f_fluc, float *f_mean, float *nb, int *np, int size)
-{
-    // nb : value of the neighbouring points.
-    // np : 1 if there is a neighbour, 0 if no neighbour.
-    int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
-    if (t_idx >= size) {return;}
-
-    // Sum terms of the mean fluctuations.
-    float f_m = f_mean[t_idx];
-    float numerator = fabsf(nb[t_idx * 8 + 0] - f_m) + fabsf(nb[t_idx * 8 + 1] - f_m)
-                      + fabsf(nb[t_idx * 8 + 2] - f_m) + fabsf(nb[t_idx * 8 + 3] - f_m)
-                      + fabsf(nb[t_idx * 8 + 4] - f_m) + fabsf(nb[t_idx * 8 + 5] - f_m)
-                      + fabsf(nb[t_idx * 8 + 6] - f_m) + fabsf(nb[t_idx * 8 + 7] - f_m);
-
-    // Mean fluctuation is normalized by number of terms summed.
-    float denominator = num_neighbours(np, t_idx);
-    f_fluc[t_idx] = numerator / denominator;
-}
-
-__global__ void rms(float *f_rms, float *f_mean, float *nb, int *np, int size)
+__global__ void mean_stats(float *f_mean, float *f_fluc, float *f_rms, const float * __restrict__ f,
+                           const unsigned char * __restrict__ np, int n, int size)
 {
-    // nb : value of the neighbouring points
-    // np : 1 if there is a neighbour, 0 if no neighbour
+    // np : bit i is set if neighbour i is present
     int t_idx = blockIdx.x * blockDim.x + threadIdx.x;
     if (t_idx >= size) {return;}
+    unsigned char np_bits = np[t_idx];
+
+    int row = t_idx / n;
+    int col = t_idx % n;
+    float denominator = num_neighbours(np_bits);
+
+    // The fields are stacked along blockIdx.y and share the neighbour bitmask.
+    f += blockIdx.y * size;
+    t_idx += blockIdx.y * size;
+
+    // Gather the neighbours into registers, with missing neighbours set to zero as in get_neighbours.
+    float nb[8];
+    #pragma unroll
+    for (int i = 0; i < 8; i++) {
+        int row_idx = row - (i < 3) + (i > 4);
+        int col_idx = col - ((i == 0) || (i == 3) || (i == 5)) + ((i == 2) || (i == 4) || (i == 7));
+        nb[i] = (np_bits >> i) & 1 ? f[row_idx * n + col_idx] : 0.0f;
+    }
 
-    // Sum terms of the rms fluctuations.
-    float f_m = f_mean[t_idx];
-    float numerator = (powf(nb[t_idx * 8 + 0] - f_m, 2) + powf(nb[t_idx * 8 + 1] - f_m, 2)
-                       + powf(nb[t_idx * 8 + 2] - f_m, 2) + powf(nb[t_idx * 8 + 3] - f_m, 2)
-                       + powf(nb[t_idx * 8 + 4] - f_m, 2) + powf(nb[t_idx * 8 + 5] - f_m, 2)
-                       + powf(nb[t_idx * 8 + 6] - f_m, 2) + powf(nb[t_idx * 8 + 7] - f_m, 2));
-
-    // RMS is normalized by number of terms summed.
-    float denominator = num_neighbours(np, t_idx);
-    f_rms[t_idx] = sqrtf(numerator / denominator);
+    // Mean of the neighbours.
+    float f_m = (nb[0] + nb[1] + nb[2] + nb[3] + nb[4] + nb[5] + nb[6] + nb[7]) / denominator;
+
+    // Mean and RMS fluctuations about the mean.
+    float fluc = 0.0f;
+    float sq_fluc = 0.0f;
+    #pragma unroll
+    for (int i = 0; i < 8; i++) {
+        float d = nb[i] - f_m;
+        fluc += fabsf(d);
+        sq_fluc += d * d;
+    }
 
+    f_mean[t_idx] = f_m;
+    f_fluc[t_idx] = fluc / denominator;
+    f_rms[t_idx] = sqrtf(sq_fluc / denominator);
 }
 """)
+_mean_stats = mod_mean_velocity.get_function('mean_stats').prepare('PPPPPii')
 
 
-def _gpu_mean_velocity(f_neighbours_d, neighbours_present_d):
-    """Calculates the mean velocity on a 3x3 grid around each point in a velocity field.
-
-    Parameters
-    ----------
-    f_neighbours_d: GPUArray
-        4D float (m, n, 8), neighbouring velocities of every point.
-    neighbours_present_d: GPUArray
-        4D int (m, n, 8), value of one where a neighbour is present.
-
-    Returns
-    -------
-    GPUArray
-        2D float (m, n), mean velocities at each point.
-
-    """
-    m, n, _ = f_neighbours_d.shape
-    size = m * n
-
-    f_mean_d = gpuarray.empty((m, n), dtype=DTYPE_f)
-
-    block_size = _BLOCK_SIZE
-    grid_size = ceil(size / block_size)
-    mean_velocity = mod_mean_velocity.get_function('mean_velocity')
-    mean_velocity(f_mean_d, f_neighbours_d, neighbours_present_d, DTYPE_i(size), block=(block_size, 1, 1),
-                  grid=(grid_size, 1))
-
-    return f_mean_d
-
+def _gpu_mean_stats(f_d, neighbours_present_d):
+    """Calculates the mean, mean fluctuation and RMS velocity on a 3x3 grid around each point in a velocity field.
 
-mod_mean_fluc = SourceModule("""
-
-""")
-
-
-def _gpu_mean_fluc(f_mean_d, f_neighbours_d, neighbours_present_d):
-    """Calculates the magnitude of the mean velocity fluctuations on a 3x3 grid around each point in a velocity field.
+    The neighbours are read from the field directly, so the (m, n, 8) array of neighbouring values is not needed.
 
     Parameters
     ----------
-    f_mean_d: GPUArray
-        2D float (m, n), mean velocities around each point.
-    f_neighbours_d : GPUArray
-        4D float (m, n, 8), neighbouring velocities of every point.
-    neighbours_present_d : GPUArray
-        4D int (m, n, 8), value of one where a neighbour is present.
-
-    Returns
-    -------
-    GPUArray
-        2D float (m, n), rms velocities at each point.
-
-    """
-    m, n = f_mean_d.shape
-    size = f_mean_d.size
-
-    f_fluc_d = gpuarray.empty((m, n), dtype=DTYPE_f)
-
-    block_size = _BLOCK_SIZE
-    grid_size = ceil(size / block_size)
-    mean_fluc = mod_mean_velocity.get_function('mean_fluc')
-    mean_fluc(f_fluc_d, f_mean_d, f_neighbours_d, neighbours_present_d, DTYPE_i(size), block=(block_size, 1, 1),
-              grid=(grid_size, 1))
-
-    return f_fluc_d
-
-
-def _gpu_rms(f_mean_d, neighbours_d, neighbours_present_d):
-    """Calculates the rms velocity in a 3x3 grid around each point in a velocity field.
-
-    Parameters
-    ----------
-    f_mean_d : GPUArray
-        2D float (m, n), mean velocities around each point.
-    neighbours_d : GPUArray
-        4D float (m, n, 8), neighbouring velocities of every point.
+    f_d : GPUArray
+        2D float (m, n) or 3D float (num_fields, m, n), velocity fields.
     neighbours_present_d : GPUArray
-        4D int (m, n, 8), value of one where a neighbour is present.
+        2D uint8 (m, n), bit i is set where neighbour i is present.
 
     Returns
     -------
-    GPUArray
-        2D float (m, n), RMS velocities at each point.
+    f_mean_d, f_mean_fluc_d, f_rms_d : GPUArray
+        float, same shape as f_d, mean velocities, mean velocity fluctuations and RMS velocities at each point.
 
     """
-    m, n = f_mean_d.shape
-    size = f_mean_d.size
+    m, n = f_d.shape[-2:]
+    size = m * n
+    num_fields = f_d.size // size
 
-    f_rms_d = gpuarray.empty((m, n), dtype=DTYPE_f)
+    f_mean_d = gpuarray.empty(f_d.shape, dtype=DTYPE_f)
+    f_mean_fluc_d = gpuarray.empty(f_d.shape, dtype=DTYPE_f)
+    f_rms_d = gpuarray.empty(f_d.shape, dtype=DTYPE_f)
 
     block_size = _BLOCK_SIZE
     grid_size = ceil(size / block_size)
-    u_rms = mod_mean_velocity.get_function('rms')
-    u_rms(f_rms_d, f_mean_d, neighbours_d, neighbours_present_d, DTYPE_i(size), block=(block_size, 1, 1),
-          grid=(grid_size, 1))
+    _mean_stats.prepared_call((grid_size, num_fields), (block_size, 1, 1), f_mean_d.gpudata, f_mean_fluc_d.gpudata,
+                              f_rms_d.gpudata, f_d.gpudata, neighbours_present_d.gpudata, n, size)
 
-    return f_rms_d
+    return f_mean_d, f_mean_fluc_d, f_rms_d
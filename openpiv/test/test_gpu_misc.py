@@ -3,6 +3,7 @@
 import numpy as np
 import pytest
 
+import pycuda.driver as cuda
 import pycuda.gpuarray as gpuarray
 
 import openpiv.gpu_misc as gpu_misc
@@ -37,10 +38,10 @@ def generate_array_pair(shape, magnitude=1.0, offset=0.0, d_type=DTYPE_f, seed=0
 
 
 # UNIT TESTS
-def test_gpu_mask():
-    shape = (16, 16)
-
-    f, f_d = generate_array_pair(shape, magnitude=2, offset=-1, d_type=DTYPE_f)
+@pytest.mark.parametrize('shape', [(16, 16), (15, 15)])
+@pytest.mark.parametrize('d_type', [DTYPE_f, DTYPE_i])
+def test_gpu_mask(shape, d_type):
+    f, f_d = generate_array_pair(shape, magnitude=10, offset=-5, d_type=d_type)
     mask, mask_d = generate_array_pair(shape, magnitude=2, d_type=DTYPE_i)
 
     f_masked = f * (1 - mask)
@@ -91,3 +92,15 @@ def test_gpu_replace_negative_f():
     f_positive_gpu = f_d.get()
 
     assert np.array_equal(f_positive_gpu, f)
+
+
+def test_to_gpu_pinned():
+    shape = (16, 16)
+
+    f = generate_np_array(shape, magnitude=255, d_type=DTYPE_i)
+    f_pinned = cuda.pagelocked_empty(shape, DTYPE_f)
+
+    f_gpu = gpu_misc._to_gpu_pinned(f, f_pinned).get()
+
+    assert f_gpu.dtype == DTYPE_f
+    assert np.array_equal(f_gpu, f.astype(DTYPE_f))
@@ -3,6 +3,7 @@ import pytest
 from math import sqrt
 
 import pycuda.gpuarray as gpuarray
+import pycuda.driver as cuda
 import scipy.interpolate as interp
 from skimage.util import random_noise
 from skimage import img_as_ubyte
@@ -68,6 +69,16 @@ def generate_cpu_gpu_pair(size, magnitude=1, dtype=DTYPE_f):
     return cpu_array, gpu_array
 
 
+def mask_peak_np(correlation, row_peak, col_peak, mask_width):
+    """Returns a copy of the correlation windows with the points around the peaks set to zero."""
+    correlation_masked = correlation.copy()
+    for k, (row, col) in enumerate(zip(row_peak, col_peak)):
+        correlation_masked[k, max(row - mask_width, 0):row + mask_width + 1,
+                           max(col - mask_width, 0):col + mask_width + 1] = 0
+
+    return correlation_masked
+
+
 # UNIT TESTS
 def test_gpu_gradient():
     u, u_d = generate_cpu_gpu_pair(_test_size_small)
@@ -138,6 +149,31 @@ def test_gpu_interpolate_mask(ndarrays_regression):
     ndarrays_regression.check({'f1': f1_d.get()})
 
 
+def test_interpolate_replace():
+    ws0 = 16
+    spacing0 = 8
+    ws1 = 8
+    spacing1 = 4
+    n_row0, n_col0 = gpu_process.get_field_shape(_test_size_medium, ws0, spacing0)
+    n_row1, n_col1 = gpu_process.get_field_shape(_test_size_medium, ws1, spacing1)
+    x0, y0 = gpu_process.get_field_coords(_test_size_medium, ws0, spacing0)
+    x1, y1 = gpu_process.get_field_coords(_test_size_medium, ws1, spacing1)
+    x0_d = gpuarray.to_gpu(x0[0, :].astype(DTYPE_f))
+    x1_d = gpuarray.to_gpu(x1[0, :].astype(DTYPE_f))
+    y0_d = gpuarray.to_gpu(y0[:, 0].astype(DTYPE_f))
+    y1_d = gpuarray.to_gpu(y1[:, 0].astype(DTYPE_f))
+
+    f0, f0_d = generate_cpu_gpu_pair((n_row0, n_col0))
+    f1, f1_d = generate_cpu_gpu_pair((n_row1, n_col1), magnitude=2)
+    val_locations, val_locations_d = generate_cpu_gpu_pair((n_row1, n_col1), magnitude=2, dtype=DTYPE_i)
+
+    f1_interp = gpu_process.gpu_interpolate(x0_d, y0_d, x1_d, y1_d, f0_d).get()
+    f1_val = np.where(val_locations, f1_interp, f1)
+    f1_val_gpu = gpu_process._interpolate_replace(x0_d, y0_d, x1_d, y1_d, f0_d, f1_d, val_locations_d).get()
+
+    assert np.array_equal(f1_val_gpu, f1_val)
+
+
 def test_gpu_ftt_shift():
     correlation_stack, correlation_stack_d = generate_cpu_gpu_pair(_test_size_small_stack)
 
@@ -147,15 +183,91 @@ def test_gpu_ftt_shift():
     assert np.allclose(shift_stack_cpu, shift_stack_gpu, _identity_tolerance)
 
 
+@pytest.mark.parametrize('d_type', (np.uint8, np.uint16, np.int16, DTYPE_f))
+@pytest.mark.parametrize('masked', (True, False))
+@pytest.mark.parametrize('shape', (_test_size_medium, (63, 65)))
+def test_gpu_frame_to_float(d_type, masked, shape):
+    frame, frame_d = generate_cpu_gpu_pair(shape, magnitude=100, dtype=d_type)
+    mask, mask_d = generate_cpu_gpu_pair(shape, magnitude=2, dtype=DTYPE_i)
+    if not masked:
+        mask = np.zeros_like(mask)
+        mask_d = None
+
+    frame_gpu = gpu_process._gpu_frame_to_float(frame_d, mask_d).get()
+
+    assert frame_gpu.dtype == DTYPE_f
+    assert np.array_equal(frame_gpu, frame.astype(DTYPE_f) * (mask == 0))
+
+
+def test_gpu_normalize_intensity_padded():
+    n_windows, ht, wd = _test_size_small_stack
+    offset = 2
+    win, _ = generate_cpu_gpu_pair((n_windows, ht, ht))
+    win_padded = np.zeros((n_windows, 2 * ht, 2 * ht), dtype=DTYPE_f)
+    win_padded[:, offset:offset + ht, offset:offset + ht] = win
+    win_padded_d = gpuarray.to_gpu(win_padded)
+
+    win_norm = np.zeros_like(win_padded)
+    win_norm[:, offset:offset + ht, offset:offset + ht] = win - win.mean(axis=(1, 2), keepdims=True)
+    win_norm_gpu = gpu_process._gpu_normalize_intensity(win_padded_d, (ht, ht), offset).get()
+
+    assert np.allclose(win_norm, win_norm_gpu, atol=1e-6)
+
+
+def test_gpu_cross_correlate():
+    win_a, win_a_d = generate_cpu_gpu_pair(_test_size_small_stack[:1] + _test_size_small)
+    win_b = np.roll(win_a, (2, -3), axis=(1, 2))
+    win_b_d = gpuarray.to_gpu(win_b)
+
+    correlation_cpu = np.fft.irfft2(np.conj(np.fft.rfft2(win_a)) * np.fft.rfft2(win_b), s=_test_size_small)
+    correlation_cpu = fftshift(correlation_cpu, axes=(1, 2))
+    correlation_gpu = gpu_process._gpu_cross_correlate(win_a_d, win_b_d).get()
+    correlation_streams_gpu = gpu_process._gpu_cross_correlate(win_a_d, win_b_d, stream_a=cuda.Stream(),
+                                                                stream_b=cuda.Stream()).get()
+
+    assert np.allclose(correlation_cpu, correlation_gpu, atol=1e-4)
+    assert np.array_equal(correlation_gpu, correlation_streams_gpu)
+
+
 def test_mask_peak():
+    n_windows, ht, wd = _test_size_small_stack
     correlation_stack, correlation_stack_d = generate_cpu_gpu_pair(_test_size_small_stack)
+    row_peak = col_peak = np.arange(n_windows, dtype=DTYPE_i)
+    row_peak_d, col_peak_d = gpuarray.to_gpu(row_peak), gpuarray.to_gpu(col_peak)
 
-    row_peak_d = gpuarray.to_gpu(np.arange(_test_size_small_stack[0], dtype=DTYPE_i))
-    col_peak_d = gpuarray.to_gpu(np.arange(_test_size_small_stack[0], dtype=DTYPE_i))
+    correlation_masked = mask_peak_np(correlation_stack, row_peak, col_peak, 2)
+    peak_idx = np.argmax(correlation_masked.reshape(n_windows, ht * wd), axis=1)
+    _, row_d, col_d = gpu_process._find_peak(correlation_stack_d, row_peak_d, col_peak_d, 2)
 
-    correlation_stack_masked_d = gpu_process._gpu_mask_peak(correlation_stack_d, row_peak_d, col_peak_d, 2)
+    assert np.all(correlation_masked[6, 4:9, 4:9] == 0)
+    assert np.array_equal(row_d.get(), peak_idx // wd)
+    assert np.array_equal(col_d.get(), peak_idx % wd)
 
-    assert np.all(correlation_stack_masked_d.get()[6, 4:9, 4:9] == 0)
+
+def test_gpu_update_field():
+    dp_u, dp_u_d = generate_cpu_gpu_pair(_test_size_small, magnitude=1)
+    dp_v, dp_v_d = generate_cpu_gpu_pair(_test_size_small, magnitude=2)
+    u_peak, u_peak_d = generate_cpu_gpu_pair(_test_size_small, magnitude=3)
+    v_peak, v_peak_d = generate_cpu_gpu_pair(_test_size_small, magnitude=4)
+    mask, mask_d = generate_cpu_gpu_pair(_test_size_small, magnitude=2, dtype=DTYPE_i)
+
+    u_d, v_d = gpu_process._gpu_update_field(dp_u_d, dp_v_d, u_peak_d, v_peak_d, mask_d)
+
+    assert np.allclose(u_d.get(), (dp_u + u_peak) * (1 - mask), _identity_tolerance)
+    assert np.allclose(v_d.get(), (dp_v + v_peak) * (1 - mask), _identity_tolerance)
+
+
+def test_gpu_replace_field():
+    u, u_d = generate_cpu_gpu_pair(_test_size_small, magnitude=1)
+    v, v_d = generate_cpu_gpu_pair(_test_size_small, magnitude=2)
+    u_rep, u_rep_d = generate_cpu_gpu_pair(_test_size_small, magnitude=3)
+    v_rep, v_rep_d = generate_cpu_gpu_pair(_test_size_small, magnitude=4)
+    val_locations, val_locations_d = generate_cpu_gpu_pair(_test_size_small, magnitude=2, dtype=DTYPE_i)
+
+    u_val_d, v_val_d = gpu_process._gpu_replace_field(u_d, v_d, u_rep_d, v_rep_d, val_locations_d)
+
+    assert np.array_equal(u_val_d.get(), np.where(val_locations, u_rep, u))
+    assert np.array_equal(v_val_d.get(), np.where(val_locations, v_rep, v))
 
 
 def test_mask_rms():
@@ -172,6 +284,79 @@ def test_mask_rms():
     assert np.allclose(correlation_stack_masked_cpu, correlation_stack_masked_gpu, _identity_tolerance)
 
 
+def test_find_peak():
+    n_windows, ht, wd = _test_size_small_stack
+    correlation_stack, correlation_stack_d = generate_cpu_gpu_pair(_test_size_small_stack, magnitude=2)
+    correlation_stack = correlation_stack - 1
+    correlation_stack_d = correlation_stack_d - DTYPE_f(1)
+
+    peak_idx = np.argmax(correlation_stack.reshape(n_windows, ht * wd), axis=1)
+    peak = np.max(correlation_stack.reshape(n_windows, ht * wd), axis=1)
+    row = np.where(peak > 0, peak_idx // wd, ht // 2)
+    col = np.where(peak > 0, peak_idx % wd, wd // 2)
+    peak_d, row_d, col_d = gpu_process._find_peak(correlation_stack_d)
+
+    assert np.array_equal(peak_d.get(), peak)
+    assert np.array_equal(row_d.get(), row)
+    assert np.array_equal(col_d.get(), col)
+
+
+def test_find_peak_masked():
+    n_windows = _test_size_small_stack[0]
+    correlation_stack, correlation_stack_d = generate_cpu_gpu_pair(_test_size_small_stack)
+    row_peak = col_peak = np.arange(n_windows, dtype=DTYPE_i)
+    row_peak_d, col_peak_d = gpuarray.to_gpu(row_peak), gpuarray.to_gpu(col_peak)
+
+    correlation_masked = mask_peak_np(correlation_stack, row_peak, col_peak, 2)
+    peak_cpu = np.max(correlation_masked.reshape(n_windows, -1), axis=1)
+    peak_d, _, _ = gpu_process._find_peak(correlation_stack_d, row_peak_d, col_peak_d, 2)
+
+    assert np.array_equal(peak_d.get(), peak_cpu)
+
+
+@pytest.mark.parametrize('n, fft_size', [(1, 2), (16, 16), (22, 24), (48, 48), (64, 64), (66, 70), (97, 98)])
+def test_get_fft_size(n, fft_size):
+    assert gpu_process._get_fft_size(n) == fft_size
+
+
+@pytest.mark.parametrize('window_size, extended_size, n_fft, fft_shape',
+                         [(16, None, 1, (16, 16)), (16, 32, 1, (32, 32)), (16, None, 2, (32, 32)),
+                          (24, None, (3, 1), (72, 72))])
+def test_get_fft_shape(window_size, extended_size, n_fft, fft_shape):
+    assert gpu_process._get_fft_shape(window_size, extended_size, n_fft) == fft_shape
+
+
+def test_fft_plan_cache():
+    plan = gpu_process._get_fft_plan(_test_size_small, DTYPE_f, np.complex64, 4)
+
+    assert gpu_process._get_fft_plan(_test_size_small, DTYPE_f, np.complex64, 4) is plan
+    assert gpu_process._get_fft_plan(_test_size_small, DTYPE_f, np.complex64, 8) is not plan
+
+    gpu_process.clear_fft_plan_cache()
+    assert gpu_process._get_fft_plan(_test_size_small, DTYPE_f, np.complex64, 4) is not plan
+
+
+def test_piv_gpu_init_fft_plans():
+    gpu_process.clear_fft_plan_cache()
+    piv_gpu = gpu_process.PIVGPU(_image_size_rectangle, window_size_iters=(1, 2), min_window_size=16)
+    n_plans = len(gpu_process._fft_plans)
+
+    frame_a, frame_b = create_pair_shift(_image_size_rectangle, _u_shift, _v_shift)
+    piv_gpu(frame_a, frame_b)
+
+    assert n_plans > 0
+    assert len(gpu_process._fft_plans) == n_plans
+
+
+def test_piv_gpu_normalized_residual():
+    piv_gpu = gpu_process.PIVGPU(_image_size_rectangle, window_size_iters=(1, 2), min_window_size=16)
+
+    frame_a, frame_b = create_pair_shift(_image_size_rectangle, _u_shift, _v_shift)
+    piv_gpu(frame_a, frame_b)
+
+    assert np.isfinite(piv_gpu.normalized_residual)
+
+
 # @pytest.mark.parametrize('image_size', (_image_size_rectangle, _image_size_square))
 # def test_gpu_piv_fast0(image_size):
 #     """Quick test of the main piv function."""
@@ -215,6 +400,37 @@ def test_gpu_piv_fast(image_size):
     assert np.linalg.norm(-v[_trim_slice, _trim_slice] - _v_shift) / sqrt(u.size) < _accuracy_tolerance
 
 
+@pytest.mark.parametrize('image_dtype', (np.uint8, np.uint16))
+def test_gpu_piv_compact_dtype(image_dtype):
+    """Tests that 8- and 16-bit frames give the same result as 32-bit frames."""
+    frame_a, frame_b = create_pair_shift(_test_size_large, _u_shift, _v_shift)
+    args = {'window_size_iters': (1, 2),
+            'min_window_size': 16,
+            }
+
+    _, _, u, v, _, _ = gpu_process.gpu_piv(frame_a, frame_b, **args)
+    _, _, u_compact, v_compact, _, _ = gpu_process.gpu_piv(frame_a.astype(image_dtype), frame_b.astype(image_dtype),
+                                                           **args)
+
+    assert np.array_equal(u, u_compact)
+    assert np.array_equal(v, v_compact)
+
+
+@pytest.mark.parametrize('n_fft', (3, 2.0, (2, 2)))
+def test_gpu_piv_n_fft(n_fft):
+    """Tests that n_fft may be any integer-valued number or pair of numbers."""
+    frame_a, frame_b = create_pair_shift(_test_size_large, _u_shift, _v_shift)
+    args = {'window_size_iters': (1, 2),
+            'min_window_size': 16,
+            'n_fft': n_fft,
+            }
+
+    x, y, u, v, mask, s2n = gpu_process.gpu_piv(frame_a, frame_b, **args)
+
+    assert np.linalg.norm(u[_trim_slice, _trim_slice] - _u_shift) / sqrt(u.size) < _accuracy_tolerance
+    assert np.linalg.norm(-v[_trim_slice, _trim_slice] - _v_shift) / sqrt(u.size) < _accuracy_tolerance
+
+
 @pytest.mark.parametrize('image_size', (_image_size_rectangle, _image_size_square))
 def test_gpu_piv_zero(image_size):
     """Tests that zero-displacement is returned when the images are empty."""
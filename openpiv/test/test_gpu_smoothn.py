@@ -253,6 +253,41 @@ def test_reflect_frequency_comp(shape):
     assert np.array_equal(y_full, z)
 
 
+@pytest.mark.parametrize('shape', [(13, 16), (16, 16)])
+@pytest.mark.parametrize('s', [0.5, 50])
+def test_gpu_smoothn_direct(shape, s):
+    y = generate_cosine_field(shape, wavelength=50) + generate_noise_field(shape, scale=0.5)
+    y_d = gpuarray.to_gpu(y)
+
+    z = gpu_smoothn.smoothn(y, s=s)[0]
+    z_gpu = gpu_smoothn.gpu_smoothn(y_d, s=s).get()
+
+    assert np.allclose(z_gpu, z, atol=1e-5)
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_gpu_smoothn_out(weighted):
+    shape = (13, 16)
+    y = generate_cosine_field(shape, wavelength=50) + generate_noise_field(shape, scale=0.5)
+    y_d = gpuarray.to_gpu(y)
+    w_d = gpuarray.to_gpu(np.linspace(0.5, 1, y.size, dtype=DTYPE_f).reshape(shape)) if weighted else None
+    out_d = gpuarray.empty(shape, dtype=DTYPE_f)
+
+    z_d = gpu_smoothn.gpu_smoothn(y_d, s=50, w=w_d)
+    z_out_d = gpu_smoothn.gpu_smoothn(y_d, s=50, w=w_d, out=out_d)
+
+    assert z_out_d is out_d
+    assert np.allclose(out_d.get(), z_d.get())
+
+
+@pytest.mark.parametrize('kwargs', [{'smooth_order': 3}, {'spacing': (1, 1, 1)}, {'spacing': (1, -1)}])
+def test_gpu_smoothn_direct_invalid_args(kwargs):
+    y_d = gpuarray.to_gpu(generate_cosine_field((16, 16), wavelength=50))
+
+    with pytest.raises(ValueError):
+        gpu_smoothn.gpu_smoothn(y_d, s=50, **kwargs)
+
+
 # INTEGRATION TESTS
 # Need tests for: mask, max_iter, smooth_order, w, z0.
 # Need to test for unexpected inputs.
@@ -62,6 +62,10 @@ def rms_np(f_mean, f_neighbours, neighbours_present):
     return f_rms_fluc
 
 
+def neighbour_validation_np(f, f_mean, f_fluc, tol):
+    return (np.abs(f - f_mean) / (f_fluc + 0.1) > tol).astype(DTYPE_i)
+
+
 def find_neighbours_np(shape, mask):
     neighbours_present = np.zeros((*shape, 8), dtype=DTYPE_i)
 
@@ -77,6 +81,10 @@ def find_neighbours_np(shape, mask):
     return neighbours_present
 
 
+def unpack_neighbours_np(neighbours_present):
+    return np.unpackbits(neighbours_present[..., np.newaxis], axis=-1, bitorder='little').astype(DTYPE_i)
+
+
 def get_neighbours_np(f, neighbours_present):
     f_neighbours = np.zeros(neighbours_present.shape, dtype=DTYPE_f)
 
@@ -204,16 +212,15 @@ def test_validation_gpu_mean_validation(validation_gpu, peaks_d, mask_d):
     tol = gpu_validation.MEAN_TOL
     validation_gpu._f_d = peaks_d
     validation_gpu._num_fields = len(peaks_d)
-    neighbours_present_d = validation_gpu._neighbours_present_d
-    val_locations_d = None
+    neighbours_present = unpack_neighbours_np(validation_gpu._neighbours_present_d.get())
+    val_locations = 0
 
     for f_d in peaks_d:
-        f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
-        f_mean_d = gpu_validation._gpu_mean_velocity(f_neighbours_d, neighbours_present_d)
-        f_mean_fluc_d = gpu_validation._gpu_mean_fluc(f_mean_d, f_neighbours_d, neighbours_present_d)
-        val_locations_d = gpu_validation._neighbour_validation(f_d, f_mean_d, f_mean_fluc_d, tol,
-                                                               val_locations_d=val_locations_d)
-    val_locations = val_locations_d.get()
+        f = f_d.get()
+        f_neighbours = get_neighbours_np(f, neighbours_present)
+        f_mean = mean_np(f_neighbours, neighbours_present)
+        f_mean_fluc = mean_fluc_np(f_mean, f_neighbours, neighbours_present)
+        val_locations = val_locations | neighbour_validation_np(f, f_mean, f_mean_fluc, tol)
     validation_gpu._mean_validation()
     val_locations_gpu = validation_gpu._val_locations_d.get()
 
@@ -224,16 +231,15 @@ def test_validation_gpu_rms_validation(validation_gpu, peaks_d, mask_d):
     tol = gpu_validation.RMS_TOL
     validation_gpu._f_d = peaks_d
     validation_gpu._num_fields = len(peaks_d)
-    neighbours_present_d = validation_gpu._neighbours_present_d
-    val_locations_d = None
+    neighbours_present = unpack_neighbours_np(validation_gpu._neighbours_present_d.get())
+    val_locations = 0
 
     for f_d in peaks_d:
-        f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
-        f_mean_d = gpu_validation._gpu_mean_velocity(f_neighbours_d, neighbours_present_d)
-        f_rms_d = gpu_validation._gpu_rms(f_mean_d, f_neighbours_d, neighbours_present_d)
-        val_locations_d = gpu_validation._neighbour_validation(f_d, f_mean_d, f_rms_d, tol,
-                                                               val_locations_d=val_locations_d)
-    val_locations = val_locations_d.get()
+        f = f_d.get()
+        f_neighbours = get_neighbours_np(f, neighbours_present)
+        f_mean = mean_np(f_neighbours, neighbours_present)
+        f_rms = np.sqrt(rms_np(f_mean, f_neighbours, neighbours_present))
+        val_locations = val_locations | neighbour_validation_np(f, f_mean, f_rms, tol)
     validation_gpu._rms_validation()
     val_locations_gpu = validation_gpu._val_locations_d.get()
 
@@ -281,13 +287,11 @@ def test_validation_gpu_get_median(validation_gpu, peaks_d):
 def test_validation_gpu_get_mean(validation_gpu, peaks_d):
     validation_gpu._f_d = peaks_d
     validation_gpu._num_fields = n = len(peaks_d)
-    neighbours_present_d = validation_gpu._neighbours_present_d
-    f_neighbours_dl = validation_gpu._get_neighbours()
+    neighbours_present = unpack_neighbours_np(validation_gpu._neighbours_present_d.get())
 
-    validation_gpu._f_neighbours_d = None
-    f_mean_l = [gpu_validation._gpu_mean_velocity(f_neighbours_dl[i], neighbours_present_d).get() for i in range(n)]
+    f_mean_l = [mean_np(get_neighbours_np(f_d.get(), neighbours_present), neighbours_present) for f_d in peaks_d]
     f_mean_gpu_l = [f_mean_d.get() for f_mean_d in validation_gpu._get_mean()]
-    assert all([np.array_equal(f_mean_gpu_l[i], f_mean_l[i]) for i in range(n)])
+    assert all([np.allclose(f_mean_gpu_l[i], f_mean_l[i]) for i in range(n)])
 
 
 def test_local_validation():
@@ -303,6 +307,18 @@ def test_local_validation():
     assert np.array_equal(val_locations_gpu, val_locations_np)
 
 
+def test_local_validation_scale():
+    shape = (16, 16)
+    scale = 0.3
+
+    f, f_d = generate_array_pair(shape, magnitude=1.0, d_type=DTYPE_f)
+
+    val_locations_np = (f / DTYPE_f(scale) > 1).astype(DTYPE_i)
+    val_locations_gpu = gpu_validation._local_validation(f_d, 1, scale=scale).get()
+
+    assert np.array_equal(val_locations_gpu, val_locations_np)
+
+
 def test_neighbour_validation():
     shape = (16, 16)
     tol = 0.5
@@ -319,25 +335,38 @@ def test_neighbour_validation():
     assert np.array_equal(val_locations_gpu, val_locations_np)
 
 
+def test_neighbour_validation_stacked():
+    shape = (2, 16, 16)
+    tol = 0.5
+
+    f, f_d = generate_array_pair(shape, magnitude=1.0, d_type=DTYPE_f)
+    f_mean, f_mean_d = generate_array_pair(shape, magnitude=1.0, d_type=DTYPE_f, seed=1)
+    f_mean_fluc, f_mean_fluc_d = generate_array_pair(shape, magnitude=1.0, d_type=DTYPE_f, seed=2)
+
+    val_locations_np = np.any(np.abs(f - f_mean) / (f_mean_fluc + 0.1) > tol, axis=0).astype(DTYPE_i)
+    val_locations_gpu = gpu_validation._neighbour_validation(f_d, f_mean_d, f_mean_fluc_d, tol).get()
+
+    assert np.array_equal(val_locations_gpu, val_locations_np)
+
+
 def test_gpu_find_neighbours():
     shape = (16, 16)
 
     mask, mask_d = generate_array_pair(shape, magnitude=2, d_type=DTYPE_i, seed=1)
 
     neighbours_present_np = find_neighbours_np(shape, mask)
-    neighbours_present_gpu = gpu_validation._gpu_find_neighbours(shape, mask_d).get()
+    neighbours_present_gpu = unpack_neighbours_np(gpu_validation._gpu_find_neighbours(shape, mask_d).get())
 
     assert (np.array_equal(neighbours_present_gpu, neighbours_present_np))
 
 
-def test_gpu_get_neighbours():
-    shape = (16, 16)
-
+@pytest.mark.parametrize('shape', [(16, 16), (15, 17), (9, 130)])
+def test_gpu_get_neighbours(shape):
     f, f_d = generate_array_pair(shape, magnitude=2.0, offset=-1.0, d_type=DTYPE_f)
     mask_d = generate_gpu_array(shape, magnitude=2, d_type=DTYPE_i, seed=1)
 
     neighbours_present_d = gpu_validation._gpu_find_neighbours(shape, mask_d)
-    f_neighbours_np = get_neighbours_np(f, neighbours_present=neighbours_present_d.get())
+    f_neighbours_np = get_neighbours_np(f, neighbours_present=unpack_neighbours_np(neighbours_present_d.get()))
     f_neighbours_gpu = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d).get()
 
     assert (np.array_equal(f_neighbours_gpu, f_neighbours_np))
@@ -351,7 +380,7 @@ def test_gpu_median_velocity():
 
     neighbours_present_d = gpu_validation._gpu_find_neighbours(shape, mask_d)
     f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
-    f_median_np = median_np(f_neighbours_d.get(), neighbours_present_d.get())
+    f_median_np = median_np(f_neighbours_d.get(), unpack_neighbours_np(neighbours_present_d.get()))
     f_median_gpu = gpu_validation._gpu_median_velocity(f_neighbours_d, neighbours_present_d).get()
 
     assert (np.array_equal(f_median_gpu, f_median_np))
@@ -366,54 +395,30 @@ def test_gpu_median_fluc():
     neighbours_present_d = gpu_validation._gpu_find_neighbours(shape, mask_d)
     f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
     f_median_d = gpu_validation._gpu_median_velocity(f_neighbours_d, neighbours_present_d)
-    f_median_fluc_np = median_fluc_np(f_median_d.get(), f_neighbours_d.get(), neighbours_present_d.get())
+    f_median_fluc_np = median_fluc_np(f_median_d.get(), f_neighbours_d.get(),
+                                      unpack_neighbours_np(neighbours_present_d.get()))
     f_median_fluc_gpu = gpu_validation._gpu_median_fluc(f_median_d, f_neighbours_d, neighbours_present_d).get()
 
     assert (np.array_equal(f_median_fluc_gpu, f_median_fluc_np))
 
 
-def test_gpu_mean_velocity():
+def test_gpu_mean_stats():
     shape = (16, 16)
 
     f, f_d = generate_array_pair(shape, magnitude=2.0, offset=-1.0, d_type=DTYPE_f)
     mask_d = generate_gpu_array(shape, magnitude=2, d_type=DTYPE_i, seed=1)
 
     neighbours_present_d = gpu_validation._gpu_find_neighbours(shape, mask_d)
-    f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
-    f_mean_np = mean_np(f_neighbours_d.get(), neighbours_present_d.get())
-    f_mean_gpu = gpu_validation._gpu_mean_velocity(f_neighbours_d, neighbours_present_d).get()
-
-    assert (np.allclose(f_mean_gpu, f_mean_np))
-
-
-def test_gpu_mean_fluc():
-    shape = (16, 16)
-
-    f, f_d = generate_array_pair(shape, magnitude=2.0, offset=-1.0, d_type=DTYPE_f)
-    mask_d = generate_gpu_array(shape, magnitude=2, d_type=DTYPE_i, seed=1)
-
-    neighbours_present_d = gpu_validation._gpu_find_neighbours(shape, mask_d)
-    f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
-    f_mean_d = gpu_validation._gpu_mean_velocity(f_neighbours_d, neighbours_present_d)
-    f_mean_fluc_np = mean_fluc_np(f_mean_d.get(), f_neighbours_d.get(), neighbours_present_d.get())
-    f_mean_fluc_gpu = gpu_validation._gpu_mean_fluc(f_mean_d, f_neighbours_d, neighbours_present_d).get()
-
-    assert (np.allclose(f_mean_fluc_gpu, f_mean_fluc_np))
-
-
-def test_gpu_rms():
-    shape = (16, 16)
-
-    f, f_d = generate_array_pair(shape, magnitude=2.0, offset=-1.0, d_type=DTYPE_f)
-    mask_d = generate_gpu_array(shape, magnitude=2, d_type=DTYPE_i, seed=1)
-
-    neighbours_present_d = gpu_validation._gpu_find_neighbours(shape, mask_d)
-    f_neighbours_d = gpu_validation._gpu_get_neighbours(f_d, neighbours_present_d)
-    f_mean_d = gpu_validation._gpu_mean_velocity(f_neighbours_d, neighbours_present_d)
-    f_rms_fluc_np = mean_fluc_np(f_mean_d.get(), f_neighbours_d.get(), neighbours_present_d.get())
-    f_rms_fluc_gpu = gpu_validation._gpu_mean_fluc(f_mean_d, f_neighbours_d, neighbours_present_d).get()
-
-    assert (np.allclose(f_rms_fluc_gpu, f_rms_fluc_np))
+    neighbours_present = unpack_neighbours_np(neighbours_present_d.get())
+    f_neighbours = get_neighbours_np(f, neighbours_present)
+    f_mean_np = mean_np(f_neighbours, neighbours_present)
+    f_mean_fluc_np = mean_fluc_np(f_mean_np, f_neighbours, neighbours_present)
+    f_rms_np = np.sqrt(rms_np(f_mean_np, f_neighbours, neighbours_present))
+    f_stats_gpu = [f_stat_d.get() for f_stat_d in gpu_validation._gpu_mean_stats(f_d, neighbours_present_d)]
+
+    assert np.allclose(f_stats_gpu[0], f_mean_np)
+    assert np.allclose(f_stats_gpu[1], f_mean_fluc_np)
+    assert np.allclose(f_stats_gpu[2], f_rms_np)
 
 
 # INTEGRATION TESTS